@@ -1,28 +1,100 @@
 import os
 import sys
 import json
-import requests
-import pyperclip
+import re
+import collections
+import concurrent.futures
+import contextlib
 import datetime
-import tkinter as tk
-from tkinter import filedialog, scrolledtext, messagebox, simpledialog, ttk
+import difflib
+import fnmatch
+import hashlib
+import html
+import io
+import select
+import struct
+import subprocess
+import queue
+import threading
+import time
+import zlib
 from pathlib import Path
 
-# Conditionally import windnd for Windows drag-and-drop
+# GUI, clipboard and network modules (tkinter, windnd, pyperclip, requests) are imported
+# only when used, so the command-line interface starts fast and runs without a display.
 IS_WINDOWS = sys.platform == "win32"
-if IS_WINDOWS:
-    try:
-        import windnd
-    except ImportError:
-        print("Warning: 'windnd' library not found. Drag and drop to window will be disabled.")
-        windnd = None # Ensure windnd is defined for later checks
-else:
-    windnd = None # Not on Windows, so windnd is not applicable
+tk = filedialog = scrolledtext = messagebox = simpledialog = ttk = None
+windnd = None
+
+def load_gui_modules():
+    global tk, filedialog, scrolledtext, messagebox, simpledialog, ttk, windnd
+    import tkinter as tk
+    from tkinter import filedialog, scrolledtext, messagebox, simpledialog, ttk
+    # Conditionally import windnd for Windows drag-and-drop
+    if IS_WINDOWS:
+        try:
+            import windnd
+        except ImportError:
+            print("Warning: 'windnd' library not found. Drag and drop to window will be disabled.")
+            windnd = None # Ensure windnd is defined for later checks
+    else:
+        windnd = None # Not on Windows, so windnd is not applicable
 
 
 CONFIG_DIR_NAME = ".context_builder"
 CONFIG_FILE_NAME = "config.json"
 CACHE_FILE_CUSTOM = "custom_instructions.cache"
+CACHE_FILE_CUSTOM_META = "custom_instructions.meta.json"
+DEFAULT_CUSTOM_INSTRUCTIONS_TTL_MINUTES = 60
+CUSTOM_INSTRUCTIONS_STALE_SECONDS = 7 * 24 * 3600
+CACHE_FILE_CONTENT = "content_cache.sqlite3"
+CONTENT_CACHE_VERSION = 2
+SNAPSHOT_DB_FILE = "snapshots.sqlite3"
+SNAPSHOTS_PER_WORKSPACE = 4  # selections remembered per workspace; the least recently built go first
+DELTA_MODES = ["off", "snapshot", "git"]
+BUILD_STATS_FILE = "build_stats.json"
+BUILD_STATS_TOP_FILES = 10
+BUILD_STATS_PANEL_ROWS = 200
+PREVIEW_CHUNK = 500  # tree entries inserted per folder at a time
+DIGEST_CHUNK_CHARS = 1 << 20
+DEDUP_MIN_CHARS = 64  # shorter files cost about as much as the reference that would replace them
+SHARD_FILE_PREFIX = "context_part_"
+SHARD_DIR = "shards"  # under the config folder; where the GUI keeps shards for "Copy Next Shard"
+SHARD_INDEX_PLACEHOLDER = 999
+SHARD_PART_PLACEHOLDER = "999/999"  # sized like the widest part label, so numbering never overflows a shard
+REDACTION_MARKER = "[REDACTED:"  # followed by the pattern name and "]"
+REDACTION_REPORT_FILES = 20
+SKELETON_VERSION = 2  # bump when an extractor's output changes, so cached skeletons are not reused
+SKELETON_CACHE_MAX_ENTRIES = 20000
+SKELETON_MAX_CONSTANT_LINES = 5  # longer assignments keep their target and show "..." as the value
+SKELETON_POOL_MIN_FILES = 8  # below this, parsing inline beats starting worker processes
+DIR_INDEX_DB_FILE = "dir_index.sqlite3"
+DIR_INDEX_VERSION = 1
+DIR_INDEX_RACY_SECONDS = 2.0  # directories changed this recently are not indexed (coarse mtime clocks)
+DEFAULT_WORKSPACE = "default"
+DEFAULT_CONTENT_CACHE_MAX_MB = 256
+
+DEFAULT_READ_WORKERS = min(8, (os.cpu_count() or 1) * 2)
+READ_PREFETCH_FACTOR = 4
+
+SNIFF_BYTES = 8192
+DEFAULT_LARGE_FILE_THRESHOLD_KB = 1024
+DEFAULT_LARGE_FILE_EXCERPT_KB = 4
+TEXT_BOMS = [(b"\xef\xbb\xbf", "utf-8-sig"), (b"\xff\xfe\x00\x00", "utf-32"), (b"\x00\x00\xfe\xff", "utf-32"),
+             (b"\xff\xfe", "utf-16"), (b"\xfe\xff", "utf-16")]
+# Bytes that count as text when sniffing: tab, newlines, form feed, escape and everything printable
+TEXT_CONTROL_BYTES = bytes([7, 8, 9, 10, 12, 13, 27]) + bytes(range(0x20, 0x100))
+ASCII_BYTES = bytes(range(0x80))
+
+CHARS_PER_TOKEN = 4
+FILE_MARKUP_TOKENS = 20     # <file>/<path>/<content> wrapper around each file
+BUDGET_STUB_TOKENS = 20     # an omitted-file note, or the marker appended to a truncated file
+BUDGET_REPORT_TOKENS = 60
+MIN_TRUNCATED_TOKENS = 200  # below this a truncated excerpt is not worth keeping
+BUDGET_REPORT_DIALOG_LINES = 15
+BUILD_POLL_MS = 50
+WATCH_POLL_SECONDS = 2.0
+WATCH_PREFETCH_BATCH = 1024
 
 DEFAULT_EXCLUDES = {
     "folders": [".git", "__pycache__", "node_modules", ".venv", "venv", "build", "dist", ".idea", ".vs"],
@@ -30,92 +102,1619 @@ DEFAULT_EXCLUDES = {
 }
 
 class AppState:
-    def __init__(self):
+    def __init__(self, load=True):
         self.home = Path.home()
         self.config_dir = self.home / CONFIG_DIR_NAME
         self.config_file = self.config_dir / CONFIG_FILE_NAME
         self.cache_file = self.config_dir / CACHE_FILE_CUSTOM
+        self.cache_meta_file = self.config_dir / CACHE_FILE_CUSTOM_META
+        self.content_cache = None
+        self.last_budget_plan = None
+        self.last_dedup = None
+        self.last_build_stats = None
+        self.watcher = None
+        self.snapshot_store = None
+        self.dir_index = None
+        self.skeleton_pool = None
+        self.redactor = None
+        self.redaction_counts = {}  # path -> secrets masked in its last read, only for paths with any
+        self.last_redactions = None
         self.data = {
             "included_paths": [],
             "excluded_paths": [],
             "excluded_types": DEFAULT_EXCLUDES["extensions"].copy(),
             "custom_instructions_url": "",
-            "use_custom_instructions": False
+            "use_custom_instructions": False,
+            "custom_instructions_ttl_minutes": DEFAULT_CUSTOM_INSTRUCTIONS_TTL_MINUTES,
+            "use_ignore_files": True,
+            "read_workers": DEFAULT_READ_WORKERS,
+            "use_content_cache": True,
+            "content_cache_max_mb": DEFAULT_CONTENT_CACHE_MAX_MB,
+            "detect_binary_files": True,
+            "large_file_threshold_kb": DEFAULT_LARGE_FILE_THRESHOLD_KB,
+            "large_file_excerpt_kb": DEFAULT_LARGE_FILE_EXCERPT_KB,
+            "token_budget": 0,
+            "tokenizer": "heuristic",
+            "budget_priority_patterns": [],
+            "skeleton_patterns": [],
+            "redact_secrets": True,
+            "shard_max_kb": 0,
+            "shard_max_tokens": 0,
+            "redaction_patterns": [],
+            "watch_mode": False,
+            "record_snapshots": True,
+            "delta_mode": "off",
+            "delta_git_revision": "HEAD",
+            "delta_include_diffs": False,
+            "use_dir_index": True,
+            "dedupe_identical_files": False,
+            "output_format": "xml",
+            "collect_build_stats": False,
+            "active_workspace": DEFAULT_WORKSPACE,
+            "workspaces": {},
+            "profiles": {}
         }
-        self.load_config()
+        if load:
+            self.load_config()
 
-    def load_config(self):
-        if self.config_file.exists():
+    def load_config(self, config_file=None):
+        config_file = Path(config_file) if config_file else self.config_file
+        if config_file.exists():
             try:
-                with self.config_file.open("r", encoding="utf-8") as f:
+                with config_file.open("r", encoding="utf-8") as f:
                     loaded = json.load(f)
                     for k, v in loaded.items():
                         if k in self.data:
                             self.data[k] = v
             except Exception as e:
-                print(f"Warning: Could not load config: {e}")
+                print(f"Warning: Could not load config: {e}", file=sys.stderr)
                 pass
 
+    def apply_profile(self, name):
+        # A profile is a named set of overrides for any config key, stored under "profiles"
+        profiles = self.data.get("profiles", {})
+        if name not in profiles:
+            raise KeyError(f"Unknown profile '{name}' (known: {', '.join(sorted(profiles)) or 'none'})")
+        for k, v in profiles[name].items():
+            if k in self.data and k != "profiles":
+                self.data[k] = v
+
+    def workspace_names(self):
+        return sorted(set(self.data["workspaces"]) | {self.data["active_workspace"]})
+
+    def store_workspace(self):
+        # The active workspace's paths live in "included_paths"; keep its entry under "workspaces" in step
+        self.data["workspaces"] = dict(self.data["workspaces"])
+        self.data["workspaces"][self.data["active_workspace"]] = list(self.data["included_paths"])
+
+    def switch_workspace(self, name, create=False):
+        if name not in self.data["workspaces"] and name != self.data["active_workspace"] and not create:
+            raise KeyError(f"Unknown workspace '{name}' (known: {', '.join(self.workspace_names())})")
+        self.store_workspace()
+        self.data["active_workspace"] = name
+        self.data["included_paths"] = list(self.data["workspaces"].get(name, []))
+
+    def delete_workspace(self, name):
+        # Removes a workspace; deleting the active one switches to the first remaining (or a new default)
+        self.store_workspace()
+        self.data["workspaces"].pop(name, None)
+        if name == self.data["active_workspace"]:
+            remaining = sorted(self.data["workspaces"])
+            self.data["active_workspace"] = remaining[0] if remaining else DEFAULT_WORKSPACE
+            self.data["included_paths"] = list(self.data["workspaces"].get(self.data["active_workspace"], []))
+
     def save_config(self):
         self.config_dir.mkdir(exist_ok=True)
+        self.store_workspace()
         with self.config_file.open("w", encoding="utf-8") as f:
             json.dump(self.data, f, indent=4)
 
-    def save_custom_instructions_cache(self, content):
+    def replace_file(self, path, text):
+        # Written beside the target and renamed over it, so a reader sees the old or the new file, never part of one
+        import tempfile
         self.config_dir.mkdir(exist_ok=True)
-        with self.cache_file.open("w", encoding="utf-8") as f:
-            f.write(content)
+        fd, tmp = tempfile.mkstemp(prefix=path.name + ".", suffix=".tmp", dir=self.config_dir)
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                f.write(text)
+            os.replace(tmp, path)
+        except BaseException:
+            with contextlib.suppress(OSError):
+                os.remove(tmp)
+            raise
+
+    def save_custom_instructions_cache(self, content):
+        self.replace_file(self.cache_file, content)
 
     def load_custom_instructions_cache(self):
         if self.cache_file.exists():
             return self.cache_file.read_text(encoding="utf-8")
         return ""
 
-state = AppState()
+    def save_custom_instructions_meta(self, meta):
+        self.replace_file(self.cache_meta_file, json.dumps(meta, indent=4))
+
+    def load_custom_instructions_meta(self):
+        try:
+            with self.cache_meta_file.open("r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+class ContentCache:
+    # Processed file contents keyed by (resolved path, size, mtime_ns), kept in SQLite next to
+    # config.json and trimmed least-recently-used first once it grows past max_bytes.
+    # Safe to share between the reader threads; writes are committed by flush().
+    def __init__(self, db_path, max_bytes):
+        self.db_path = Path(db_path)
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.db_path.parent.mkdir(exist_ok=True)
+        import sqlite3
+        self.conn = sqlite3.connect(str(self.db_path), check_same_thread=False)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS entries (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER,"
+                          " signature TEXT, content TEXT, nbytes INTEGER, last_used REAL, redactions INTEGER DEFAULT 0)")
+        if "redactions" not in [row[1] for row in self.conn.execute("PRAGMA table_info(entries)")]:
+            # Caches from before redaction counts were stored; their rows no longer match the signature anyway
+            self.conn.execute("ALTER TABLE entries ADD COLUMN redactions INTEGER DEFAULT 0")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used)")
+        # Skeletons depend only on the content they were made from, so they are keyed by its digest
+        self.conn.execute("CREATE TABLE IF NOT EXISTS skeletons (key TEXT PRIMARY KEY, skeleton TEXT, last_used REAL)")
+        self.conn.commit()
+        self.touched = []
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        # Settings that change how files are processed invalidate earlier entries
+        self.signature = content_cache_signature()
+
+    def get(self, path_str, size, mtime_ns):
+        with self.lock:
+            row = self.conn.execute("SELECT content, redactions FROM entries WHERE path = ? AND size = ? AND mtime_ns = ? AND signature = ?",
+                                    (path_str, size, mtime_ns, self.signature)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.touched.append(path_str)
+            return row[0], row[1]
+
+    def put(self, path_str, size, mtime_ns, content, redactions=0):
+        # max_bytes caps the stored UTF-8, not the number of characters
+        nbytes = len(content.encode("utf-8", errors="surrogatepass"))
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                              (path_str, size, mtime_ns, self.signature, content, nbytes, time.time(), redactions))
+
+    def flush(self):
+        with self.lock:
+            if self.touched:
+                now = time.time()
+                self.conn.executemany("UPDATE entries SET last_used = ? WHERE path = ?", ((now, p) for p in self.touched))
+                self.touched = []
+            self.evict()
+            self.conn.execute("DELETE FROM skeletons WHERE key NOT IN (SELECT key FROM skeletons ORDER BY last_used DESC LIMIT ?)",
+                              (SKELETON_CACHE_MAX_ENTRIES,))
+            self.conn.commit()
+
+    def get_skeleton(self, key):
+        with self.lock:
+            row = self.conn.execute("SELECT skeleton FROM skeletons WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                self.conn.execute("UPDATE skeletons SET last_used = ? WHERE key = ?", (time.time(), key))
+            return row[0] if row else None
+
+    def put_skeleton(self, key, skeleton):
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO skeletons VALUES (?, ?, ?)", (key, skeleton, time.time()))
+
+    def evict(self):
+        total = self.conn.execute("SELECT COALESCE(SUM(nbytes), 0) FROM entries").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        doomed = []
+        for path_str, nbytes in self.conn.execute("SELECT path, nbytes FROM entries ORDER BY last_used"):
+            if total <= self.max_bytes:
+                break
+            doomed.append((path_str,))
+            total -= nbytes
+        self.conn.executemany("DELETE FROM entries WHERE path = ?", doomed)
+
+    def clear(self):
+        with self.lock:
+            self.conn.execute("DELETE FROM entries")
+            self.conn.execute("DELETE FROM skeletons")
+            self.conn.commit()
+            self.conn.execute("VACUUM")
+            self.touched = []
+
+    def stats_text(self):
+        return f"Content cache: {self.hits} hits, {self.misses} misses"
+
+def content_cache_signature():
+    return "v{}|binary={}|large={}|excerpt={}".format(
+        CONTENT_CACHE_VERSION, state.data.get("detect_binary_files", True),
+        state.data.get("large_file_threshold_kb", DEFAULT_LARGE_FILE_THRESHOLD_KB),
+        state.data.get("large_file_excerpt_kb", DEFAULT_LARGE_FILE_EXCERPT_KB)) + redaction_signature()
+
+def get_content_cache():
+    # One shared cache per process, or None when disabled in Settings
+    if not state.data.get("use_content_cache", True):
+        return None
+    max_bytes = int(state.data.get("content_cache_max_mb", DEFAULT_CONTENT_CACHE_MAX_MB)) * 1024 * 1024
+    if state.content_cache is None:
+        try:
+            state.content_cache = ContentCache(state.config_dir / CACHE_FILE_CONTENT, max_bytes)
+        except Exception as e:
+            print(f"Warning: Content cache disabled: {e}", file=sys.stderr)
+            return None
+    state.content_cache.max_bytes = max_bytes
+    return state.content_cache
+
+class SnapshotStore:
+    # Manifest of the last build per workspace and selection (see workspace_key): for each file
+    # its size, mtime_ns, a content digest and, only while diffs are requested, the
+    # zlib-compressed processed content (so later delta builds can diff against it). At most
+    # SNAPSHOTS_PER_WORKSPACE snapshots per workspace, and they go when the workspace is deleted.
+    def __init__(self, db_path):
+        import sqlite3
+        Path(db_path).parent.mkdir(exist_ok=True)
+        self.conn = sqlite3.connect(str(db_path), check_same_thread=False)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS files (workspace TEXT, path TEXT, size INTEGER, mtime_ns INTEGER,"
+                          " digest TEXT, content BLOB, PRIMARY KEY (workspace, path))")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS snapshots (workspace TEXT PRIMARY KEY, created_at REAL)")
+        self.conn.commit()
+
+    def manifest(self, workspace):
+        rows = self.conn.execute("SELECT path, size, mtime_ns, digest, content IS NOT NULL FROM files WHERE workspace = ?", (workspace,))
+        return {path: (size, mtime_ns, digest, bool(has_content)) for path, size, mtime_ns, digest, has_content in rows}
+
+    def created_at(self, workspace):
+        row = self.conn.execute("SELECT created_at FROM snapshots WHERE workspace = ?", (workspace,)).fetchone()
+        return row[0] if row else None
+
+    def old_content(self, workspace, path_str):
+        row = self.conn.execute("SELECT content FROM files WHERE workspace = ? AND path = ?", (workspace, path_str)).fetchone()
+        if row is None or row[0] is None:
+            return None
+        return zlib.decompress(row[0]).decode("utf-8", errors="replace")
+
+    def put(self, workspace, path_str, size, mtime_ns, digest, content):
+        # content=None records the digest only
+        blob = zlib.compress(content.encode("utf-8", errors="surrogatepass"), 1) if content is not None else None
+        self.conn.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)", (workspace, path_str, size, mtime_ns, digest, blob))
+
+    def update_stamp(self, workspace, path_str, size, mtime_ns):
+        self.conn.execute("UPDATE files SET size = ?, mtime_ns = ? WHERE workspace = ? AND path = ?", (size, mtime_ns, workspace, path_str))
+
+    def remove(self, workspace, paths):
+        self.conn.executemany("DELETE FROM files WHERE workspace = ? AND path = ?", ((workspace, p) for p in paths))
+
+    def drop_contents(self, workspace):
+        # Diffs were turned off: the stored copies are no longer needed
+        self.conn.execute("UPDATE files SET content = NULL WHERE workspace = ? AND content IS NOT NULL", (workspace,))
+
+    def commit(self, workspace):
+        self.conn.execute("INSERT OR REPLACE INTO snapshots VALUES (?, ?)", (workspace, time.time()))
+        name = workspace.rpartition("\n")[0]
+        keys = [key for key, in self.conn.execute("SELECT workspace FROM snapshots ORDER BY created_at DESC")
+                if key.rpartition("\n")[0] == name]
+        self.drop(keys[SNAPSHOTS_PER_WORKSPACE:])
+        self.conn.commit()
+
+    def drop(self, keys):
+        for table in ("files", "snapshots"):
+            self.conn.executemany(f"DELETE FROM {table} WHERE workspace = ?", ((key,) for key in keys))
+
+    def drop_workspaces_except(self, workspaces):
+        # Snapshots of deleted workspaces (and of keys from older versions) are removed
+        keep = set(workspaces)
+        keys = {key for table in ("files", "snapshots") for key, in self.conn.execute(f"SELECT DISTINCT workspace FROM {table}")}
+        self.drop([key for key in keys if "\n" not in key or key.rpartition("\n")[0] not in keep])
+        self.conn.commit()
+
+    def rollback(self):
+        self.conn.rollback()
+
+class SnapshotRecorder:
+    # Brings a workspace's manifest up to date with one build; nothing is visible until commit()
+    def __init__(self, store, workspace, keep_contents=False):
+        self.store = store
+        self.workspace = workspace
+        self.keep_contents = keep_contents
+        self.previous = store.manifest(workspace)
+        self.seen = set()
+
+    def unchanged_by_stat(self, path_str):
+        # True when size and mtime match the manifest; the file then need not be read at all
+        prev = self.previous.get(path_str)
+        if prev is None or (self.keep_contents and not prev[3]):
+            # Diffs were just turned on: the file is read once so its content can be kept
+            return False
+        try:
+            st = os.stat(path_str)
+        except OSError:
+            return False
+        if (st.st_size, st.st_mtime_ns) == prev[:2]:
+            self.seen.add(path_str)
+            return True
+        return False
+
+    def add(self, path_str, content, digest=None):
+        # Records the file and returns "added", "modified" or None when its content is unchanged
+        self.seen.add(path_str)
+        try:
+            st = os.stat(path_str)
+            stamp = (st.st_size, st.st_mtime_ns)
+        except OSError:
+            stamp = (-1, -1)
+        digest = digest or content_digest(content)
+        prev = self.previous.get(path_str)
+        if prev is not None and prev[2] == digest:
+            if self.keep_contents and not prev[3]:
+                # Keep the copy the next change will be diffed against
+                self.store.put(self.workspace, path_str, stamp[0], stamp[1], digest, content)
+            elif prev[:2] != stamp:
+                self.store.update_stamp(self.workspace, path_str, *stamp)
+            return None
+        self.store.put(self.workspace, path_str, stamp[0], stamp[1], digest, content if self.keep_contents else None)
+        return "modified" if prev is not None else "added"
+
+    def deleted(self):
+        return sorted(p for p in self.previous if p not in self.seen)
+
+    def commit(self):
+        self.store.remove(self.workspace, self.deleted())
+        if not self.keep_contents:
+            self.store.drop_contents(self.workspace)
+        self.store.commit(self.workspace)
+
+    def rollback(self):
+        self.store.rollback()
+
+def content_digest(content):
+    # Hashed slice by slice so a large file is never copied into one bytes object
+    h = hashlib.blake2b(digest_size=16)
+    for start in range(0, len(content), DIGEST_CHUNK_CHARS):
+        h.update(content[start:start + DIGEST_CHUNK_CHARS].encode("utf-8", errors="surrogatepass"))
+    return h.hexdigest()
+
+class Deduplicator:
+    # Remembers the first path emitted for each content digest during one build
+    def __init__(self):
+        self.first_paths = {}
+        self.duplicates = 0
+        self.bytes_saved = 0
+
+    def first_occurrence(self, path_str, content, digest=None):
+        # Path of an earlier file with identical content, or None if this file is emitted in full
+        if len(content) < DEDUP_MIN_CHARS:
+            return None
+        first = self.first_paths.setdefault(digest or content_digest(content), path_str)
+        if first == path_str:
+            return None
+        self.duplicates += 1
+        self.bytes_saved += len(content.encode("utf-8", errors="surrogatepass"))
+        return first
+
+    def stats_text(self):
+        return f"Deduplication: {self.duplicates} identical files referenced, {self.bytes_saved / 1024:.1f} KB saved"
+
+def workspace_key():
+    # Snapshots belong to the workspace and the selection they were taken of, so building
+    # other paths (from the CLI, or after changing the selection) keeps the earlier baseline
+    paths = sorted({str(Path(p).resolve()) for p in state.data["included_paths"]})
+    selection = hashlib.blake2b("\n".join(paths).encode("utf-8", errors="surrogatepass"), digest_size=8).hexdigest()
+    return f"{state.data['active_workspace']}\n{selection}"
+
+def get_snapshot_store():
+    if state.snapshot_store is None:
+        try:
+            state.snapshot_store = SnapshotStore(state.config_dir / SNAPSHOT_DB_FILE)
+            state.snapshot_store.drop_workspaces_except(state.workspace_names())
+        except Exception as e:
+            print(f"Warning: Snapshots disabled: {e}", file=sys.stderr)
+            return None
+    return state.snapshot_store
+
+class DirectoryIndex:
+    # Record of every walked directory, keyed by its absolute path so any workspace or selection
+    # that reaches it reuses the row: its mtime_ns, the stamps of the ignore files in it and its
+    # filtered files and subdirectories. A directory whose mtime and ignore files are unchanged
+    # is served from here instead of being listed again.
+    def __init__(self, db_path):
+        import sqlite3
+        Path(db_path).parent.mkdir(exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(str(db_path), check_same_thread=False)
+        if "workspace" in [row[1] for row in self.conn.execute("PRAGMA table_info(dirs)")]:
+            # Rows of older versions were kept per workspace
+            self.conn.execute("DROP TABLE dirs")
+            self.conn.execute("DROP TABLE IF EXISTS workspaces")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS dirs (path TEXT PRIMARY KEY, mtime_ns INTEGER, rules TEXT,"
+                          " ignore_files TEXT, files TEXT, subdirs TEXT)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self.conn.commit()
+        self.loaded = None  # {dir: (mtime_ns, rules, ignore_files, files, subdirs)}, kept between builds
+        self.last_walk = None
+
+    def begin(self, signature):
+        with self.lock:
+            row = self.conn.execute("SELECT value FROM meta WHERE key = 'signature'").fetchone()
+            if row is None or row[0] != signature:
+                # Exclusion settings changed (or first walk): every filtered listing is stale
+                self.conn.execute("DELETE FROM dirs")
+                self.conn.execute("INSERT OR REPLACE INTO meta VALUES ('signature', ?)", (signature,))
+                self.conn.commit()
+                self.loaded = {}
+            elif self.loaded is None:
+                rows = self.conn.execute("SELECT path, mtime_ns, rules, ignore_files, files, subdirs FROM dirs")
+                self.loaded = {row[0]: row[1:] for row in rows}
+            self.last_walk = IndexedWalk(self, self.loaded)
+            return self.last_walk
+
+    def save(self, updates, removed):
+        with self.lock:
+            self.conn.executemany("INSERT OR REPLACE INTO dirs VALUES (?, ?, ?, ?, ?, ?)",
+                                  ((path, mtime_ns, rules, json.dumps(ignore_files), json.dumps(files), json.dumps(subdirs))
+                                   for path, (mtime_ns, rules, ignore_files, files, subdirs) in updates.items()))
+            self.conn.executemany("DELETE FROM dirs WHERE path = ?", ((p,) for p in removed))
+            self.conn.commit()
+
+    def stats_text(self):
+        walk = self.last_walk
+        if walk is None:
+            return "Directory index: not used"
+        return f"Directory index: {walk.hits} folders reused, {walk.misses} listed"
+
+class IndexedWalk:
+    # One walk against the index; new listings are written back by finish()
+    def __init__(self, index, entries):
+        self.index = index
+        self.entries = entries
+        self.visited = set()
+        self.updates = {}
+        self.fingerprints = {}
+        self.hits = 0
+        self.misses = 0
+
+    def stat_dir(self, dir_str):
+        try:
+            return os.stat(dir_str).st_mtime_ns
+        except OSError:
+            return None
+
+    def rules_fingerprint(self, rules):
+        # Identifies the ignore rules inherited from parent folders, which shaped the stored listing
+        fp = self.fingerprints.get(rules)
+        if fp is None:
+            h = hashlib.blake2b(digest_size=16)
+            for r in rules:
+                h.update(r.base_prefix.encode("utf-8", errors="surrogatepass") + b"\0")
+                h.update("\n".join(r.lines).encode("utf-8", errors="surrogatepass") + b"\0")
+            fp = self.fingerprints[rules] = h.hexdigest()
+        return fp
+
+    def lookup(self, dir_str, mtime_ns, inherited_rules):
+        # (ignore rules, files, subdirectory names) for an unchanged directory, or None if it must be listed
+        self.visited.add(dir_str)
+        entry = self.entries.get(dir_str)
+        if entry is None or mtime_ns is None or entry[0] != mtime_ns or entry[1] != self.rules_fingerprint(inherited_rules):
+            self.misses += 1
+            return None
+        mtime_ns, rules_fp, ignore_files, files, subdirs = entry
+        if isinstance(files, str):
+            ignore_files, files, subdirs = json.loads(ignore_files), json.loads(files), json.loads(subdirs)
+            self.entries[dir_str] = (mtime_ns, rules_fp, ignore_files, files, subdirs)
+        own_rules = ()
+        for name, size, ignore_mtime_ns in ignore_files:
+            ignore_path = os.path.join(dir_str, name)
+            try:
+                st = os.stat(ignore_path)
+            except OSError:
+                self.misses += 1
+                return None
+            if (st.st_size, st.st_mtime_ns) != (size, ignore_mtime_ns):
+                self.misses += 1
+                return None
+            own_rules += (IgnoreRules.from_file(dir_str, ignore_path),)
+        self.hits += 1
+        return inherited_rules + tuple(r for r in own_rules if r.patterns), files, subdirs
+
+    def record(self, dir_str, mtime_ns, inherited_rules, entries, files, subdirs, matcher):
+        self.visited.add(dir_str)
+        # A directory modified within the mtime resolution of "now" could change again without
+        # its mtime moving, so it is only indexed once it has been quiet for a moment
+        if mtime_ns is None or time.time_ns() - mtime_ns < DIR_INDEX_RACY_SECONDS * 1e9:
+            self.entries.pop(dir_str, None)
+            return
+        ignore_files = []
+        if matcher.use_ignore_files:
+            for entry in entries:
+                if entry.name in IGNORE_FILE_NAMES:
+                    try:
+                        st = entry.stat()
+                    except OSError:
+                        return
+                    ignore_files.append([entry.name, st.st_size, st.st_mtime_ns])
+        row = (mtime_ns, self.rules_fingerprint(inherited_rules), ignore_files, files, subdirs)
+        self.entries[dir_str] = self.updates[dir_str] = row
+
+    def finish(self, complete, roots):
+        # Folders under the walked roots that a complete walk did not reach are gone or now
+        # excluded; rows elsewhere belong to other selections and are kept
+        removed = []
+        if complete and roots:
+            prefixes = tuple(root.rstrip(os.sep) + os.sep for root in roots)
+            removed = [p for p in self.entries if p not in self.visited and (p in roots or p.startswith(prefixes))]
+        for p in removed:
+            del self.entries[p]
+        if self.updates or removed:
+            self.index.save(self.updates, removed)
+        self.updates = {}
+        self.fingerprints = {}
+
+def dir_index_signature():
+    # Filtered listings depend on these settings; the index is emptied when they change
+    return json.dumps([DIR_INDEX_VERSION, sorted(state.data["excluded_paths"]), sorted(ext.lower() for ext in state.data["excluded_types"]),
+                       DEFAULT_EXCLUDES["folders"], state.data.get("use_ignore_files", True)])
+
+def get_dir_index():
+    # One shared index per process, or None when disabled in Settings
+    if not state.data.get("use_dir_index", True):
+        return None
+    if state.dir_index is None:
+        try:
+            state.dir_index = DirectoryIndex(state.config_dir / DIR_INDEX_DB_FILE)
+        except Exception as e:
+            print(f"Warning: Directory index disabled: {e}", file=sys.stderr)
+            return None
+    return state.dir_index
+
+# Config is loaded by the GUI/CLI entry points, not at import time
+state = AppState(load=False)
+
+custom_instructions_lock = threading.Lock()  # one fetch at a time; held for the network round trip
+custom_instructions_file_lock = threading.Lock()  # held only while the cache and its metadata are read or written together
 
 def fetch_custom_instructions(url):
+    # Served from custom_instructions.cache while it is younger than the TTL. Past the TTL a
+    # cached copy is still returned immediately and revalidated in the background, until it
+    # is older than TTL + stale window; only then does the build wait for the network.
+    # A TTL of 0 means every build revalidates before it continues.
     if not url:
         return ""
-    try:
-        r = requests.get(url, timeout=10)
-        r.raise_for_status()
-        content = r.text
-        state.save_custom_instructions_cache(content)
-        return content
-    except Exception as e:
-        return f"<!-- Failed to fetch custom instructions: {e} -->"
+    with custom_instructions_file_lock:
+        meta = state.load_custom_instructions_meta()
+        cached = state.load_custom_instructions_cache() if meta.get("url") == url and state.cache_file.exists() else None
+    ttl = int(state.data.get("custom_instructions_ttl_minutes", DEFAULT_CUSTOM_INSTRUCTIONS_TTL_MINUTES)) * 60
+    if ttl > 0 and cached is not None:
+        age = time.time() - meta.get("fetched_at", 0)
+        if age < ttl:
+            return cached
+        if age < ttl + CUSTOM_INSTRUCTIONS_STALE_SECONDS:
+            revalidate_custom_instructions_in_background(url)
+            return cached
+    return revalidate_custom_instructions(url)
+
+def revalidate_custom_instructions(url, timeout=10):
+    # Conditional GET using the stored ETag/Last-Modified; on any failure the cached copy is used if there is one
+    with custom_instructions_lock:
+        with custom_instructions_file_lock:
+            meta = state.load_custom_instructions_meta()
+            # A cache written before metadata was kept is assumed to belong to the configured URL
+            has_cache = state.cache_file.exists() and meta.get("url", url) == url
+            cached = state.load_custom_instructions_cache() if has_cache else None
+        headers = {}
+        if has_cache and meta.get("url") == url:
+            if meta.get("etag"):
+                headers["If-None-Match"] = meta["etag"]
+            if meta.get("last_modified"):
+                headers["If-Modified-Since"] = meta["last_modified"]
+        try:
+            import requests
+            r = requests.get(url, timeout=timeout, headers=headers)
+            if r.status_code == 304 and has_cache:
+                meta["fetched_at"] = time.time()
+                with custom_instructions_file_lock:
+                    state.save_custom_instructions_meta(meta)
+                return cached
+            r.raise_for_status()
+            content = r.text
+            with custom_instructions_file_lock:
+                state.save_custom_instructions_cache(content)
+                state.save_custom_instructions_meta({"url": url, "fetched_at": time.time(),
+                                                     "etag": r.headers.get("ETag", ""),
+                                                     "last_modified": r.headers.get("Last-Modified", "")})
+            return content
+        except Exception as e:
+            if has_cache:
+                print(f"Warning: Could not refresh custom instructions ({e}), using cached copy.", file=sys.stderr)
+                return cached
+            return f"<!-- Failed to fetch custom instructions: {e} -->"
+
+def revalidate_custom_instructions_in_background(url):
+    # Skipped while another fetch holds the lock; that fetch refreshes the cache anyway
+    if custom_instructions_lock.locked():
+        return None
+    thread = threading.Thread(target=revalidate_custom_instructions, args=(url,), name="custom-instructions", daemon=True)
+    thread.start()
+    return thread
+
+def prefetch_custom_instructions():
+    # Called at startup so the first build finds a fresh cache
+    url = state.data.get("custom_instructions_url", "")
+    if not (state.data.get("use_custom_instructions") and url):
+        return None
+    meta = state.load_custom_instructions_meta()
+    ttl = int(state.data.get("custom_instructions_ttl_minutes", DEFAULT_CUSTOM_INSTRUCTIONS_TTL_MINUTES)) * 60
+    if meta.get("url") == url and time.time() - meta.get("fetched_at", 0) < ttl and state.cache_file.exists():
+        return None
+    return revalidate_custom_instructions_in_background(url)
+
+class XmlSerializer:
+    # The <context> document. Every method returns the lines for one part of it; file bodies
+    # are CDATA sections, split wherever the text itself contains "]]>".
+    name = "xml"
+    extension = ".xml"
+    indent = "    "
+
+    def pad(self, level):
+        return self.indent * level
+
+    def cdata(self, text):
+        return "<![CDATA[" + text.replace("]]>", "]]]]><![CDATA[>") + "]]>"
+
+    def escape(self, text):
+        # Paths and revisions go into element text and attributes as-is, so &, < and > must be escaped
+        return html.escape(text, quote=True)
+
+    def begin(self, timestamp):
+        return ["<context>", f"{self.pad(1)}<timestamp>{timestamp}</timestamp>"]
+
+    def section(self, tag, text):
+        # instructions, output, custom_instructions and budget_report
+        return [f"{self.pad(1)}<{tag}>", text, f"{self.pad(1)}</{tag}>"]
+
+    def begin_files(self, delta_base=None):
+        if delta_base is not None:
+            return [f'{self.pad(1)}<repository_changes base="{self.escape(delta_base)}">']
+        return [f"{self.pad(1)}<repository_structure>"]
+
+    def shard(self, index, final, entries):
+        # Header of one shard: its position and the files (or file parts) it holds
+        lines = [f'{self.pad(1)}<shard index="{index}" final="{str(final).lower()}">', f"{self.pad(2)}<manifest>"]
+        lines.extend(f'{self.pad(3)}<path part="{part}">{self.escape(rel)}</path>' if part else f"{self.pad(3)}<path>{self.escape(rel)}</path>"
+                     for rel, part in entries)
+        return lines + [f"{self.pad(2)}</manifest>", f"{self.pad(1)}</shard>"]
+
+    def file(self, rel, content=None, status=None, diff=None, duplicate_of=None, part=None):
+        attrs = (f' status="{status}"' if status else "") + (f' part="{part}"' if part else "")
+        lines = [f"{self.pad(2)}<file{attrs}>", f"{self.pad(3)}<path>{self.escape(rel)}</path>"]
+        if diff is not None:
+            lines.append(f"{self.pad(3)}<diff>{self.cdata(diff)}</diff>")
+        elif duplicate_of is not None:
+            lines.append(f"{self.pad(3)}<duplicate_of>{self.escape(duplicate_of)}</duplicate_of>")
+        else:
+            lines.append(f"{self.pad(3)}<content>{self.cdata(content)}</content>")
+        lines.append(f"{self.pad(2)}</file>")
+        return lines
+
+    def deleted_files(self, rels):
+        return [f"{self.pad(2)}<deleted_files>"] + [self.escape(rel) for rel in rels] + [f"{self.pad(2)}</deleted_files>"]
+
+    def end_files(self, delta_base=None):
+        return [f"{self.pad(1)}</repository_changes>" if delta_base is not None else f"{self.pad(1)}</repository_structure>"]
+
+    def end(self):
+        return ["</context>"]
+
+class CompactXmlSerializer(XmlSerializer):
+    # Same elements without indentation, each file on as few lines as its content allows
+    name = "xml-compact"
+    indent = ""
+
+    def section(self, tag, text):
+        return [f"<{tag}>{text}</{tag}>"]
+
+    def file(self, rel, content=None, status=None, diff=None, duplicate_of=None, part=None):
+        return ["".join(XmlSerializer.file(self, rel, content, status, diff, duplicate_of, part))]
+
+    def deleted_files(self, rels):
+        return ["<deleted_files>" + "\n".join(self.escape(rel) for rel in rels) + "</deleted_files>"]
+
+class MarkdownSerializer:
+    # Headings per section and one fenced block per file; fences grow past any backtick run in the file
+    name = "markdown"
+    extension = ".md"
+    titles = {"instructions": "Instructions", "output": "Output", "custom_instructions": "Custom Instructions", "budget_report": "Budget Report"}
+
+    def fence(self, text):
+        longest = max((len(run) for run in re.findall(r"`{3,}", text)), default=2)
+        return "`" * (longest + 1)
+
+    def begin(self, timestamp):
+        return ["# Context", "", f"Generated: {timestamp}"]
+
+    def section(self, tag, text):
+        return ["", f"## {self.titles.get(tag, tag)}", "", text]
+
+    def begin_files(self, delta_base=None):
+        return ["", f"## Changes since {delta_base}" if delta_base is not None else "## Files"]
+
+    def shard(self, index, final, entries):
+        lines = ["", f"## Shard {index}" + (" (final)" if final else " (more shards follow)"), ""]
+        return lines + [f"- {rel}" + (f" (part {part})" if part else "") for rel, part in entries]
+
+    def file(self, rel, content=None, status=None, diff=None, duplicate_of=None, part=None):
+        notes = [note for note in (status, f"part {part}" if part else None) if note]
+        lines = ["", f"### {rel}" + (f" ({', '.join(notes)})" if notes else ""), ""]
+        if duplicate_of is not None:
+            return lines + [f"Same content as `{duplicate_of}`."]
+        body = diff if diff is not None else content
+        fence = self.fence(body)
+        info = "diff" if diff is not None else os.path.splitext(rel)[1].lstrip(".")
+        return lines + [fence + info, body.rstrip("\n"), fence]
+
+    def deleted_files(self, rels):
+        return ["", "### Deleted files", ""] + [f"- {rel}" for rel in rels]
 
-def build_context(task_instructions, error_output):
+    def end_files(self, delta_base=None):
+        return []
+
+    def end(self):
+        return []
+
+class JsonLinesSerializer:
+    # One JSON object per line: a "context" record, then one record per section, file and deletion list
+    name = "jsonl"
+    extension = ".jsonl"
+
+    def record(self, **fields):
+        return [json.dumps(fields, ensure_ascii=False)]
+
+    def begin(self, timestamp):
+        return self.record(type="context", timestamp=timestamp)
+
+    def section(self, tag, text):
+        return self.record(type=tag, text=text)
+
+    def begin_files(self, delta_base=None):
+        return self.record(type="changes", base=delta_base) if delta_base is not None else []
+
+    def shard(self, index, final, entries):
+        return self.record(type="shard", index=index, final=final,
+                           files=[{"path": rel, "part": part} if part else {"path": rel} for rel, part in entries])
+
+    def file(self, rel, content=None, status=None, diff=None, duplicate_of=None, part=None):
+        fields = {"type": "file", "path": rel}
+        if status:
+            fields["status"] = status
+        if part:
+            fields["part"] = part
+        if diff is not None:
+            fields["diff"] = diff
+        elif duplicate_of is not None:
+            fields["duplicate_of"] = duplicate_of
+        else:
+            fields["content"] = content
+        return self.record(**fields)
+
+    def deleted_files(self, rels):
+        return self.record(type="deleted", paths=list(rels))
+
+    def end_files(self, delta_base=None):
+        return []
+
+    def end(self):
+        return []
+
+# Output formats: name -> zero-argument factory
+SERIALIZERS = {"xml": XmlSerializer, "xml-compact": CompactXmlSerializer, "markdown": MarkdownSerializer, "jsonl": JsonLinesSerializer}
+
+def get_serializer(name=None):
+    name = name or state.data.get("output_format", "xml")
+    if name not in SERIALIZERS:
+        print(f"Warning: Unknown output format '{name}', using xml.", file=sys.stderr)
+        name = "xml"
+    return SERIALIZERS[name]()
+
+def build_context(task_instructions, error_output, progress=None, serializer=None):
+    return "\n".join(iter_context(task_instructions, error_output, progress, serializer))
+
+def write_context(out, task_instructions, error_output, progress=None, serializer=None):
+    # Streams the same document build_context returns into a text stream (file, stdout, pipe)
+    first = True
+    for line in iter_context(task_instructions, error_output, progress, serializer):
+        if not first:
+            out.write("\n")
+        out.write(line)
+        first = False
+
+def iter_context(task_instructions, error_output, progress=None, serializer=None):
+    # Yields the document line by line in the chosen output format; only the file currently
+    # being emitted is held in memory
+    out = serializer or get_serializer()
+    stats = BuildStats() if state.data.get("collect_build_stats", False) else None
+    state.last_build_stats = stats
+    timed = stats.stage if stats is not None else contextlib.nullcontext
+    build_started = time.perf_counter()
     timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-    parts = []
-    parts.append("<context>")
-    parts.append(f"    <timestamp>{timestamp}</timestamp>")
+    header = out.begin(timestamp)
 
     if task_instructions.strip():
-        parts.append("    <instructions>")
-        parts.append(task_instructions)
-        parts.append("    </instructions>")
+        header.extend(out.section("instructions", task_instructions))
 
     if error_output.strip():
-        parts.append("    <output>")
-        parts.append(error_output)
-        parts.append("    </output>")
+        header.extend(out.section("output", error_output))
 
     if state.data.get("use_custom_instructions"):
         url = state.data.get("custom_instructions_url", "")
         content = ""
-        if url:
-            content = fetch_custom_instructions(url)
+        with timed("custom instructions"):
+            if url:
+                content = fetch_custom_instructions(url)
+            else:
+                content = state.load_custom_instructions_cache()
+        header.extend(out.section("custom_instructions", content if content.strip() else "<!-- No custom instructions content -->"))
+
+    # A running watcher already knows the file list and most contents
+    watcher = state.watcher if state.watcher is not None and state.watcher.running else None
+    if watcher is not None:
+        with timed("walk"):
+            included_files = watcher.current_files()
+        read_contents = watcher.iter_contents
+    else:
+        included_files = collect_included_files(progress, stats)
+        read_contents = iter_file_contents
+    # Skeleton files are swapped in at read time so the budget, dedup and delta all see what is emitted
+    is_skeleton = skeleton_selector()
+    if is_skeleton is not None:
+        read_contents = skeleton_reader(read_contents, is_skeleton)
+    base_for_relpath = get_base_for_relpath()
+    workers = state.data.get("read_workers", DEFAULT_READ_WORKERS)
+
+    cache = get_content_cache()
+    if cache is not None:
+        cache.reset_stats()
+
+    delta_mode = state.data.get("delta_mode", "off")
+    with_diffs = state.data.get("delta_include_diffs", False)
+    recorder = None
+    if delta_mode == "snapshot" or (delta_mode != "git" and state.data.get("record_snapshots", True)):
+        store = get_snapshot_store()
+        if store is not None:
+            recorder = SnapshotRecorder(store, workspace_key(), keep_contents=with_diffs)
+    try:
+        delta = None
+        with timed("delta") if delta_mode in ("snapshot", "git") else contextlib.nullcontext():
+            if delta_mode == "snapshot":
+                if recorder is None:
+                    raise RuntimeError("Delta mode 'snapshot' needs the snapshot store, which could not be opened")
+                delta = snapshot_delta(included_files, recorder, read_contents, workers, cache, progress, with_diffs)
+            elif delta_mode == "git":
+                delta = git_delta(included_files, state.data.get("delta_git_revision") or "HEAD", with_diffs)
+        emit_files = delta.changed_paths() if delta is not None else included_files
+
+        dedup = Deduplicator() if state.data.get("dedupe_identical_files", False) else None
+        state.last_dedup = dedup
+        redactions = RedactionReport() if get_redactor() is not None else None
+        state.last_redactions = redactions
+
+        plan = None
+        state.last_budget_plan = None
+        budget = int(state.data.get("token_budget", 0) or 0)
+        if budget > 0:
+            counter = get_token_counter()
+            overhead = sum(counter.count(line) for line in header) + BUDGET_REPORT_TOKENS
+            with timed("token budget"):
+                plan = plan_token_budget(emit_files, base_for_relpath, budget, overhead, counter, workers, cache, progress, read_contents,
+                                         dedupe=dedup is not None)
+            state.last_budget_plan = plan
+            header.extend(out.section("budget_report", plan.summary_text()))
+
+        delta_base = delta.base if delta is not None else None
+        yield from header
+        yield from out.begin_files(delta_base)
+        if progress is not None:
+            progress.start_reading(len(emit_files))
+        emit_started = time.perf_counter()
+        for fpath_str, fcontent in read_contents(emit_files, workers, cache, stats):
+            if progress is not None:
+                progress.file_read(fpath_str, len(fcontent))
+            digest = None
+            if recorder is not None and delta is None and not recorder.unchanged_by_stat(fpath_str):
+                # Only files whose stat changed since the last snapshot are hashed
+                digest = content_digest(fcontent)
+                recorder.add(fpath_str, fcontent, digest)
+            rel = relative_display_path(fpath_str, base_for_relpath)
+            if redactions is not None:
+                masked = redactions.add(rel, state.redaction_counts.get(fpath_str, 0))
+                if masked and stats is not None:
+                    stats.counts["secrets_redacted"] += masked
+                    stats.counts["files_with_secrets"] += 1
+            status = delta.changed[fpath_str] if delta is not None else None
+            old = delta.old_contents.get(fpath_str) if delta is not None else None
+            first = None
+            if dedup is not None and old is None and (plan is None or plan.may_reference(fpath_str)):
+                first = dedup.first_occurrence(fpath_str, fcontent, digest)
+            emitted = ""
+            if old is not None:
+                emitted = unified_diff_text(rel, old, fcontent)
+                yield from out.file(rel, status=status, diff=emitted)
+            elif first is not None:
+                yield from out.file(rel, status=status, duplicate_of=relative_display_path(first, base_for_relpath))
+            else:
+                emitted = plan.apply(fpath_str, fcontent) if plan is not None else fcontent
+                yield from out.file(rel, emitted, status=status)
+            if stats is not None:
+                stats.file_emitted(fpath_str, rel, len(fcontent.encode("utf-8", errors="surrogatepass")), emitted)
+        if stats is not None:
+            # Includes the time the consumer (clipboard buffer, file, pipe) spent on each line
+            stats.add_time("read + serialize + write", time.perf_counter() - emit_started)
+        if cache is not None:
+            cache.flush()
+        if delta is not None and delta.deleted:
+            yield from out.deleted_files(relative_display_path(p, base_for_relpath) for p in delta.deleted)
+        yield from out.end_files(delta_base)
+        if recorder is not None:
+            recorder.commit()
+    except BaseException:
+        # Cancelled or failed builds leave the previous snapshot untouched
+        if recorder is not None:
+            recorder.rollback()
+        raise
+    yield from out.end()
+    if stats is not None:
+        stats.add_time("total", time.perf_counter() - build_started)
+        save_build_stats(stats)
+
+def save_build_stats(stats, path=None):
+    # The latest report is kept in the config folder; failures only warn
+    try:
+        state.config_dir.mkdir(exist_ok=True)
+        stats.write_json(path or state.config_dir / BUILD_STATS_FILE)
+    except OSError as e:
+        print(f"Warning: Could not write build stats: {e}", file=sys.stderr)
+
+class ShardPart(str):
+    # The lines of one serializer call joined into one string and tagged with the call, so the
+    # sharder can see the document's structure through iter_context. Code that treats the
+    # stream as plain lines (budget overhead, token counts) is unaffected.
+    def __new__(cls, kind, lines, args=()):
+        part = str.__new__(cls, "\n".join(lines))
+        part.kind = kind
+        part.args = args
+        return part
+
+class TaggingSerializer:
+    # Wraps a serializer so every call yields a single ShardPart
+    def __init__(self, inner):
+        self.inner = inner
+        self.name = inner.name
+        self.extension = inner.extension
+
+    def begin(self, timestamp):
+        return [ShardPart("begin", self.inner.begin(timestamp), (timestamp,))]
+
+    def section(self, tag, text):
+        return [ShardPart("section", self.inner.section(tag, text))]
+
+    def begin_files(self, delta_base=None):
+        return [ShardPart("begin_files", self.inner.begin_files(delta_base), (delta_base,))]
+
+    def file(self, rel, content=None, status=None, diff=None, duplicate_of=None):
+        return [ShardPart("file", self.inner.file(rel, content, status, diff, duplicate_of), (rel, content, status, diff, duplicate_of))]
+
+    def deleted_files(self, rels):
+        rels = list(rels)
+        return [ShardPart("deleted", self.inner.deleted_files(rels), (rels,))]
+
+    def end_files(self, delta_base=None):
+        return [ShardPart("end_files", self.inner.end_files(delta_base))]
+
+    def end(self):
+        return [ShardPart("end", self.inner.end())]
+
+class Shard:
+    def __init__(self, index, text, entries, final):
+        self.index = index
+        self.text = text
+        self.entries = entries  # [(rel, part or None)] as listed in the shard's manifest
+        self.final = final
+
+def sharding_enabled():
+    return bool(int(state.data.get("shard_max_kb", 0) or 0) or int(state.data.get("shard_max_tokens", 0) or 0))
+
+class Sharder:
+    # Packs file units into shards bounded by bytes and/or tokens. Sizes are summed per unit, so
+    # a token limit is approximate (tokenization is not quite additive); byte limits are exact.
+    def __init__(self, serializer, max_bytes=0, max_tokens=0):
+        self.out = serializer
+        self.max_bytes = max_bytes
+        self.max_tokens = max_tokens
+        self.counter = get_token_counter() if max_tokens else None
+
+    def size(self, text):
+        # (bytes, tokens) of text plus the newline that joins it to the next line
+        return (len(text.encode("utf-8", errors="surrogatepass")) + 1,
+                self.counter.count(text) if self.counter is not None else 0)
+
+    def lines_size(self, lines):
+        sizes = [self.size(line) for line in lines]
+        return sum(b for b, _ in sizes), sum(t for _, t in sizes)
+
+    def fits(self, used, extra):
+        return ((not self.max_bytes or used[0] + extra[0] <= self.max_bytes)
+                and (not self.max_tokens or used[1] + extra[1] <= self.max_tokens))
+
+    def entry_size(self, entry):
+        # What one manifest entry adds to a shard header
+        with_entry = self.lines_size(self.out.shard(SHARD_INDEX_PLACEHOLDER, False, [entry]))
+        without = self.lines_size(self.out.shard(SHARD_INDEX_PLACEHOLDER, False, []))
+        return with_entry[0] - without[0], with_entry[1] - without[1]
+
+    def chunks(self, rel, args, used):
+        # An oversized file as numbered parts that each fit next to used. The body is first cut
+        # into as many roughly equal pieces as its size calls for, between lines where possible;
+        # a piece that still renders too big (escaping, long lines) is halved again.
+        _, content, status, diff, _ = args
+        body = diff if diff is not None else content
+        is_diff = diff is not None
+
+        def too_big(piece):
+            text = "\n".join(self.render_part(rel, piece, status, is_diff, SHARD_PART_PLACEHOLDER))
+            extra = tuple(a + b for a, b in zip(self.size(text), self.entry_size((rel, SHARD_PART_PLACEHOLDER))))
+            return not self.fits(used, extra)
+
+        size = self.size(body)
+        rooms = [(total, limit - taken) for total, limit, taken in zip(size, (self.max_bytes, self.max_tokens), used) if limit]
+        count = max([-(-total // max(1, room)) for total, room in rooms] + [1])
+        pieces = split_text(body, count)
+        done = []
+        while pieces:
+            piece = pieces.pop(0)
+            if len(piece) <= 1 or not too_big(piece):
+                done.append(piece)
+            else:
+                pieces[:0] = split_text(piece, 2)
+        total = len(done)
+        return [("\n".join(self.render_part(rel, piece, status, is_diff, f"{i}/{total}")), (rel, f"{i}/{total}"))
+                for i, piece in enumerate(done, 1)]
+
+    def deleted_chunks(self, rels, used):
+        # An oversized deleted-files list as several shorter lists that each fit next to used;
+        # only a single path longer than the limit is left as it is
+        pieces, done = [rels], []
+        while pieces:
+            piece = pieces.pop(0)
+            text = "\n".join(self.out.deleted_files(piece))
+            if len(piece) <= 1 or self.fits(used, self.size(text)):
+                done.append((text, None))
+            else:
+                half = len(piece) // 2
+                pieces[:0] = [piece[:half], piece[half:]]
+        return done
+
+    def render_part(self, rel, piece, status, is_diff, part):
+        if is_diff:
+            return self.out.file(rel, status=status, diff=piece, part=part)
+        return self.out.file(rel, piece, status=status, part=part)
+
+def split_text(text, count):
+    # text in count roughly equal consecutive pieces, each ending at a line break where one is
+    # near; the pieces concatenate back to text
+    pieces, start = [], 0
+    for i in range(1, count):
+        target = len(text) * i // count
+        if target <= start:
+            continue
+        cut = text.rfind("\n", start, target) + 1
+        if cut <= start or target - cut > len(text) // (count * 4) + 1:
+            cut = target
+        pieces.append(text[start:cut])
+        start = cut
+    pieces.append(text[start:])
+    return [piece for piece in pieces if piece] or [text]
+
+def iter_shards(task_instructions, error_output, progress=None, serializer=None):
+    # Streams the context as Shard objects. A shard is complete (and yielded) once the next
+    # unit does not fit, so only one shard and one file are held at a time. The first shard
+    # also carries the instructions and other sections.
+    out = serializer or get_serializer()
+    sharder = Sharder(out, int(state.data.get("shard_max_kb", 0) or 0) * 1024, int(state.data.get("shard_max_tokens", 0) or 0))
+    timestamp, delta_base, sections = "", None, []
+    index, units, entries, used = 1, [], [], (0, 0)
+
+    def frame_size():
+        lines = out.begin(timestamp) + out.shard(index, False, []) + out.begin_files(delta_base) + out.end_files(delta_base) + out.end()
+        size = sharder.lines_size(lines)
+        if index == 1:
+            size = tuple(a + b for a, b in zip(size, sharder.lines_size(sections)))
+        return size
+
+    def render(final):
+        lines = out.begin(timestamp) + out.shard(index, final, entries)
+        if index == 1:
+            lines += sections
+        return "\n".join(lines + out.begin_files(delta_base) + units + out.end_files(delta_base) + out.end())
+
+    for part in iter_context(task_instructions, error_output, progress, TaggingSerializer(out)):
+        if part.kind == "begin":
+            timestamp = part.args[0]
+        elif part.kind == "section":
+            sections.append(part)
+        elif part.kind == "begin_files":
+            delta_base = part.args[0]
+            used = frame_size()
+        elif part.kind in ("file", "deleted"):
+            if part.kind == "file":
+                rel = part.args[0]
+                pending = [(str(part), (rel, None))]
+                extra = tuple(a + b for a, b in zip(sharder.size(part), sharder.entry_size((rel, None))))
+            else:
+                pending = [(str(part), None)]
+                extra = sharder.size(part)
+            if not sharder.fits(used, extra):
+                if units or (index == 1 and sections):
+                    yield Shard(index, render(False), entries, False)
+                    index, units, entries = index + 1, [], []
+                    used = frame_size()
+                if not sharder.fits(used, extra):
+                    pending = sharder.chunks(rel, part.args, used) if part.kind == "file" else sharder.deleted_chunks(part.args[0], used)
+            for text, entry in pending:
+                extra = sharder.size(text)
+                if entry is not None:
+                    extra = tuple(a + b for a, b in zip(extra, sharder.entry_size(entry)))
+                if units and not sharder.fits(used, extra):
+                    yield Shard(index, render(False), entries, False)
+                    index, units, entries = index + 1, [], []
+                    used = frame_size()
+                units.append(text)
+                if entry is not None:
+                    entries.append(entry)
+                used = tuple(a + b for a, b in zip(used, extra))
+    yield Shard(index, render(True), entries, True)
+
+def write_shards(directory, task_instructions, error_output, progress=None, serializer=None):
+    # Writes context_part_001.xml, ... into a hidden folder inside directory as they are produced.
+    # Only once the build has finished are the previous parts (including those of an earlier,
+    # larger build) replaced by them, so a cancelled or failed build leaves the old set intact.
+    import shutil
+    import tempfile
+    out = serializer or get_serializer()
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    staging = Path(tempfile.mkdtemp(prefix=".shards-", dir=directory))
+    try:
+        names = []
+        for shard in iter_shards(task_instructions, error_output, progress, out):
+            name = f"{SHARD_FILE_PREFIX}{shard.index:03d}{out.extension}"
+            with open(staging / name, "w", encoding="utf-8", newline="") as f:
+                f.write(shard.text)
+            names.append(name)
+        for old in directory.iterdir():
+            if re.fullmatch(re.escape(SHARD_FILE_PREFIX) + r"\d+\.\w+", old.name):
+                old.unlink()
+        paths = []
+        for name in names:
+            os.replace(staging / name, directory / name)
+            paths.append(directory / name)
+        return paths
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+
+def copy_text_to_clipboard(text):
+    # pyperclip.copy, timed as the "clipboard" stage when the build collected stats
+    import pyperclip
+    stats = state.last_build_stats
+    if stats is None:
+        pyperclip.copy(text)
+        return
+    with stats.stage("clipboard"):
+        pyperclip.copy(text)
+    save_build_stats(stats)
+
+class ContextDelta:
+    # Files that changed relative to a base (last snapshot or a git revision)
+    def __init__(self, base):
+        self.base = base
+        self.changed = {}       # path -> "added" | "modified"
+        self.deleted = []
+        self.old_contents = {}  # path -> previous processed content, only when diffs are requested
+
+    def changed_paths(self):
+        return sorted(self.changed)
+
+def snapshot_delta(included_files, recorder, read_contents, workers, cache, progress, with_diffs):
+    # Files whose size and mtime match the manifest are not read; the rest are read and
+    # compared by digest, which also records them in the new snapshot
+    created_at = recorder.store.created_at(recorder.workspace)
+    if created_at is None:
+        base = "none (first snapshot)"
+    else:
+        base = "snapshot " + datetime.datetime.fromtimestamp(created_at).strftime("%Y%m%d_%H%M%S")
+    delta = ContextDelta(base)
+    candidates = [p for p in included_files if not recorder.unchanged_by_stat(p)]
+    if progress is not None:
+        progress.start_reading(len(candidates), "Comparing")
+    for path_str, content in read_contents(candidates, workers, cache):
+        if progress is not None:
+            progress.file_read(path_str, len(content))
+        old = None
+        if with_diffs and path_str in recorder.previous:
+            old = recorder.store.old_content(recorder.workspace, path_str)
+        status = recorder.add(path_str, content)
+        if status is not None:
+            delta.changed[path_str] = status
+            if status == "modified" and old is not None:
+                delta.old_contents[path_str] = old
+    delta.deleted = recorder.deleted()
+    return delta
+
+def git_delta(included_files, revision, with_diffs):
+    # Tracked changes between `revision` and the working tree plus untracked files, limited
+    # to what the current selection and exclusions would include
+    included = set(included_files)
+    matcher = ExclusionMatcher.from_state()
+    roots = git_work_trees()
+    if not roots:
+        raise RuntimeError("Delta mode 'git' needs the included paths to be inside a git work tree")
+    delta = ContextDelta(f"git {revision}")
+    for root in roots:
+        fields = run_git(root, "diff", "--name-status", "--no-renames", "-z", revision, "--").split("\0")
+        for status, rel in zip(fields[0::2], fields[1::2]):
+            path_str = os.path.normpath(os.path.join(root, rel))
+            if status.startswith("D"):
+                if is_path_in_selection(path_str, matcher):
+                    delta.deleted.append(path_str)
+            elif path_str in included:
+                delta.changed[path_str] = "added" if status.startswith("A") else "modified"
+                if with_diffs and not status.startswith("A"):
+                    old = git_old_content(root, revision, rel, path_str)
+                    if old is not None:
+                        delta.old_contents[path_str] = old
+        for rel in run_git(root, "ls-files", "--others", "--exclude-standard", "-z").split("\0"):
+            path_str = os.path.normpath(os.path.join(root, rel)) if rel else None
+            if path_str in included:
+                delta.changed[path_str] = "added"
+    delta.deleted.sort()
+    return delta
+
+def run_git(cwd, *args):
+    try:
+        result = subprocess.run(["git", "-C", cwd] + list(args), capture_output=True, check=True)
+    except FileNotFoundError:
+        raise RuntimeError("git was not found on PATH")
+    except subprocess.CalledProcessError as e:
+        raise RuntimeError(f"git {' '.join(args[:2])} failed: {e.stderr.decode('utf-8', errors='replace').strip()}")
+    return result.stdout.decode("utf-8", errors="surrogateescape")
+
+def git_work_trees():
+    roots = []
+    for p_str in state.data["included_paths"]:
+        p = Path(p_str)
+        start = p if p.is_dir() else p.parent
+        try:
+            root = run_git(str(start), "rev-parse", "--show-toplevel").strip()
+        except RuntimeError:
+            continue
+        root = os.path.normpath(str(Path(root).resolve()))
+        if root not in roots:
+            roots.append(root)
+    return roots
+
+def git_old_content(root, revision, rel, path_str):
+    try:
+        result = subprocess.run(["git", "-C", root, "show", f"{revision}:{rel}"], capture_output=True, check=True)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    is_binary, encoding = classify_content(result.stdout[:SNIFF_BYTES])
+    if is_binary:
+        return None
+    return process_text_content(Path(path_str), decode_text(result.stdout, encoding))[0]
+
+def is_path_in_selection(path_str, matcher):
+    # Whether a (possibly no longer existing) path lies in the selection and passes the exclusions
+    for p_str in state.data["included_paths"]:
+        root = os.path.normpath(str(Path(p_str).resolve()))
+        if path_str == root or path_str.startswith(root + os.sep):
+            return not matcher.is_excluded_file(path_str)
+    return False
+
+def unified_diff_text(rel, old, new):
+    lines = difflib.unified_diff(old.splitlines(keepends=True), new.splitlines(keepends=True), f"a/{rel}", f"b/{rel}")
+    return "".join(line if line.endswith("\n") else line + "\n" for line in lines)
+
+class HeuristicTokenCounter:
+    # Roughly four characters per token for code and English prose; no dependencies
+    name = "heuristic"
+
+    def count(self, text):
+        return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+    def truncate(self, text, max_tokens):
+        return text[:max_tokens * CHARS_PER_TOKEN]
+
+class TiktokenCounter:
+    # Exact counts for OpenAI-style BPE vocabularies; needs the optional 'tiktoken' package
+    name = "tiktoken"
+
+    def __init__(self, encoding_name="cl100k_base"):
+        import tiktoken
+        self.encoding = tiktoken.get_encoding(encoding_name)
+
+    def count(self, text):
+        return len(self.encoding.encode(text, disallowed_special=()))
+
+    def truncate(self, text, max_tokens):
+        return self.encoding.decode(self.encoding.encode(text, disallowed_special=())[:max_tokens])
+
+# Further tokenizers can be registered here: name -> zero-argument factory returning count()/truncate()
+TOKEN_COUNTERS = {"heuristic": HeuristicTokenCounter, "tiktoken": TiktokenCounter}
+
+def get_token_counter(name=None):
+    name = name or state.data.get("tokenizer", "heuristic")
+    try:
+        return TOKEN_COUNTERS[name]()
+    except Exception as e:
+        print(f"Warning: Tokenizer '{name}' unavailable ({e}), using heuristic estimate.", file=sys.stderr)
+        return HeuristicTokenCounter()
+
+class BudgetPlan:
+    # Per-file decisions for one build: "full", "truncated" (keeping kept_tokens) or "omitted"
+    def __init__(self, budget, overhead, counter):
+        self.budget = budget
+        self.overhead = overhead
+        self.counter = counter
+        self.decisions = {}  # path -> (decision, tokens, kept_tokens)
+        self.rel_paths = {}
+        self.duplicate_of = {}  # later copy -> first path with the same content
+        self.used = overhead
+
+    def apply(self, path_str, content):
+        decision, tokens, kept = self.decisions.get(path_str, ("full", 0, 0))
+        if decision == "full":
+            return content
+        if decision == "omitted":
+            return f"[omitted to fit the token budget: ~{tokens} tokens]"
+        truncated = self.counter.truncate(content, kept)
+        cut = truncated.rfind("\n")
+        if cut > len(truncated) // 2:
+            truncated = truncated[:cut + 1]
+        return truncated + f"\n[... truncated to fit the token budget: ~{kept} of ~{tokens} tokens shown ...]"
+
+    def may_reference(self, path_str):
+        # A copy is emitted as a reference only when its first occurrence is kept in full
+        first = self.duplicate_of.get(path_str)
+        return first is None or self.decisions[first][0] == "full"
+
+    def cut_files(self, decision):
+        return [(self.rel_paths[p], tokens, kept) for p, (d, tokens, kept) in sorted(self.decisions.items()) if d == decision]
+
+    def summary_text(self):
+        truncated, omitted = self.cut_files("truncated"), self.cut_files("omitted")
+        return (f"Token budget: {self.budget}, estimated use: {self.used} ({self.counter.name}). "
+                f"{len(self.decisions) - len(truncated) - len(omitted)} files in full, {len(truncated)} truncated, {len(omitted)} omitted.")
+
+    def report_text(self):
+        lines = [f"Token budget: {self.budget}, estimated use: {self.used} ({self.counter.name})",
+                 f"Instructions and markup: ~{self.overhead} tokens"]
+        truncated, omitted = self.cut_files("truncated"), self.cut_files("omitted")
+        if not truncated and not omitted:
+            lines.append(f"All {len(self.decisions)} files fit in full.")
+        for rel, tokens, kept in truncated:
+            lines.append(f"Truncated: {rel} ({kept} of {tokens} tokens)")
+        for rel, tokens, _ in omitted:
+            lines.append(f"Omitted: {rel} ({tokens} tokens)")
+        return "\n".join(lines)
+
+def plan_token_budget(included_files, base_for_relpath, budget, overhead, counter, workers=DEFAULT_READ_WORKERS, cache=None, progress=None,
+                      read_contents=None, dedupe=False):
+    # First pass counts tokens per file (contents are not kept; with the content cache the
+    # second, emitting pass is cheap). Files are then ranked and packed greedily: every file
+    # is guaranteed at least an omitted stub, the best-ranked ones are upgraded to full
+    # text while budget remains, and the first one that no longer fits is truncated.
+    plan = BudgetPlan(budget, overhead, counter)
+    tokens = {}
+    dedup = Deduplicator() if dedupe else None
+    if progress is not None:
+        progress.start_reading(len(included_files), "Counting tokens")
+    for path_str, content in (read_contents or iter_file_contents)(included_files, workers, cache):
+        if progress is not None:
+            progress.file_read(path_str, len(content))
+        # Later copies of identical content are emitted as references and cost no content tokens
+        first = dedup.first_occurrence(path_str, content) if dedup is not None else None
+        if first is not None:
+            plan.duplicate_of[path_str] = first
+        else:
+            tokens[path_str] = counter.count(content)
+        plan.rel_paths[path_str] = relative_display_path(path_str, base_for_relpath)
+    explicit = set()
+    for p_str in state.data["included_paths"]:
+        p = Path(p_str)
+        if p.is_file():
+            explicit.add(str(p.resolve()))
+    patterns = [pat for pat in state.data.get("budget_priority_patterns", []) if pat]
+
+    def rank(path_str):
+        rel = plan.rel_paths[path_str]
+        if path_str in explicit:
+            tier = 0
+        elif any(fnmatch.fnmatch(rel, pat) or fnmatch.fnmatch(os.path.basename(rel), pat) for pat in patterns):
+            tier = 1
         else:
-            content = state.load_custom_instructions_cache()
-        
-        parts.append("    <custom_instructions>")
-        parts.append(content if content.strip() else "<!-- No custom instructions content -->")
-        parts.append("    </custom_instructions>")
+            tier = 2
+        return (tier, rel.count("/"), tokens[path_str], rel)
+
+    remaining = budget - overhead - len(included_files) * (FILE_MARKUP_TOKENS + BUDGET_STUB_TOKENS)
+    for path_str in sorted((p for p in included_files if p not in plan.duplicate_of), key=rank):
+        needed = tokens[path_str] - BUDGET_STUB_TOKENS
+        if needed <= remaining:
+            plan.decisions[path_str] = ("full", tokens[path_str], tokens[path_str])
+            remaining -= max(needed, 0)
+        elif remaining >= MIN_TRUNCATED_TOKENS:
+            plan.decisions[path_str] = ("truncated", tokens[path_str], remaining)
+            remaining = 0
+        else:
+            plan.decisions[path_str] = ("omitted", tokens[path_str], 0)
+    # A copy follows its first occurrence; if that was cut, the copy is omitted too (a second
+    # truncated copy would not fit) rather than referencing text the output does not contain
+    for path_str, first in plan.duplicate_of.items():
+        decision, first_tokens, _ = plan.decisions[first]
+        plan.decisions[path_str] = ("full", 0, 0) if decision == "full" else ("omitted", first_tokens, 0)
+    plan.used = budget - remaining
+    return plan
+
+class BuildCancelled(Exception):
+    pass
+
+class BuildProgress:
+    # Counters shared between a build on a worker thread and the code displaying it.
+    # The build calls file_discovered/file_read, which also raise BuildCancelled once
+    # cancel() has been called; report(snapshot) is invoked at most every `interval` seconds.
+    def __init__(self, report=None, interval=0.1):
+        self.report = report
+        self.interval = interval
+        self.cancel_event = threading.Event()
+        self.stage = "Scanning"
+        self.files_discovered = 0
+        self.files_total = 0
+        self.files_read = 0
+        self.bytes_read = 0
+        self.current_path = ""
+        self.last_report = 0.0
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    def cancelled(self):
+        return self.cancel_event.is_set()
+
+    def check_cancelled(self):
+        if self.cancel_event.is_set():
+            raise BuildCancelled()
+
+    def file_discovered(self, path_str, count):
+        self.files_discovered = count
+        self.current_path = path_str
+        self.changed()
+
+    def start_reading(self, total, stage="Reading"):
+        self.stage = stage
+        self.files_total = total
+        self.files_read = 0
+        self.bytes_read = 0
+        self.changed(force=True)
+
+    def file_read(self, path_str, nbytes):
+        self.files_read += 1
+        self.bytes_read += nbytes
+        self.current_path = path_str
+        self.changed()
+
+    def changed(self, force=False):
+        self.check_cancelled()
+        if self.report is None:
+            return
+        now = time.monotonic()
+        if force or now - self.last_report >= self.interval:
+            self.last_report = now
+            self.report(self.snapshot())
+
+    def snapshot(self):
+        return {"stage": self.stage, "files_discovered": self.files_discovered, "files_total": self.files_total,
+                "files_read": self.files_read, "bytes_read": self.bytes_read, "current_path": self.current_path}
+
+class BuildStats:
+    # Optional instrumentation of one build: wall time per stage, per-file size, read time and
+    # tokens, aggregated into a report. Reads run on worker threads, so file updates take a lock.
+    def __init__(self, counter=None):
+        self.counter = counter or get_token_counter()
+        self.started_at = time.time()
+        self.stages = {}
+        self.counts = collections.Counter()
+        self.files = {}  # path -> {"rel", "bytes", "read_seconds", "tokens"}
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        with self.lock:
+            self.stages.setdefault(name, 0.0)  # report stages in the order they started
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def add_time(self, name, seconds):
+        with self.lock:
+            self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def entry(self, path_str):
+        return self.files.setdefault(path_str, {"rel": path_str, "bytes": 0, "read_seconds": 0.0, "tokens": 0})
+
+    def timed_read(self, path_str, cache=None):
+        # Drop-in for read_file_content that records how long the file took
+        start = time.perf_counter()
+        content = read_file_content(path_str, cache)
+        elapsed = time.perf_counter() - start
+        with self.lock:
+            self.entry(path_str)["read_seconds"] = elapsed
+            self.counts["files_read"] += 1
+        return content
+
+    def file_emitted(self, path_str, rel, nbytes, emitted_text):
+        tokens = self.counter.count(emitted_text) if emitted_text else 0
+        with self.lock:
+            e = self.entry(path_str)
+            e["rel"], e["bytes"], e["tokens"] = rel, nbytes, tokens
+            self.counts["files_emitted"] += 1
+            self.counts["bytes_emitted"] += nbytes
 
-    parts.append("    <repository_structure>")
-    included_files = collect_included_files()
+    def tokens_by_directory(self):
+        totals = collections.Counter()
+        for e in self.files.values():
+            top = e["rel"].split("/", 1)[0] if "/" in e["rel"] else "."
+            totals[top] += e["tokens"]
+        return dict(totals.most_common())
 
+    def report(self, top=BUILD_STATS_TOP_FILES):
+        files = list(self.files.values())
+        return {
+            "started_at": datetime.datetime.fromtimestamp(self.started_at).isoformat(timespec="seconds"),
+            "tokenizer": self.counter.name,
+            "stages": {name: round(seconds, 4) for name, seconds in self.stages.items()},
+            "counts": dict(self.counts),
+            "total_tokens": sum(e["tokens"] for e in files),
+            "largest_files": [{"path": e["rel"], "bytes": e["bytes"]} for e in sorted(files, key=lambda e: -e["bytes"])[:top]],
+            "slowest_files": [{"path": e["rel"], "seconds": round(e["read_seconds"], 4)}
+                              for e in sorted(files, key=lambda e: -e["read_seconds"])[:top] if e["read_seconds"] > 0],
+            "tokens_by_directory": self.tokens_by_directory(),
+            "files": sorted(({"path": e["rel"], "bytes": e["bytes"], "read_seconds": round(e["read_seconds"], 5), "tokens": e["tokens"]}
+                             for e in files), key=lambda f: f["path"]),
+        }
+
+    def report_text(self, top=BUILD_STATS_TOP_FILES):
+        r = self.report(top)
+        lines = ["Stages (wall time):"] + [f"  {name}: {seconds:.3f}s" for name, seconds in r["stages"].items()]
+        lines.append(f"Files emitted: {r['counts'].get('files_emitted', 0)}, read: {r['counts'].get('files_read', 0)}, "
+                     f"~{r['total_tokens']} tokens ({r['tokenizer']})")
+        lines.append("Tokens by top-level folder:")
+        lines += [f"  {name}: {tokens}" for name, tokens in list(r["tokens_by_directory"].items())[:top]]
+        lines.append("Largest files:")
+        lines += [f"  {f['path']}: {f['bytes']} bytes" for f in r["largest_files"]]
+        lines.append("Slowest reads:")
+        lines += [f"  {f['path']}: {f['seconds'] * 1000:.1f} ms" for f in r["slowest_files"]]
+        return "\n".join(lines)
+
+    def write_json(self, path):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.report(), f, indent=2)
+
+def get_base_for_relpath():
     base_for_relpath = Path.cwd()
     if state.data["included_paths"]:
         try:
@@ -128,36 +1727,543 @@ def build_context(task_instructions, error_output):
                         base_for_relpath = common
         except Exception:
             pass
+    return base_for_relpath
 
-    for fpath_str in included_files:
-        fpath = Path(fpath_str)
+def relative_display_path(fpath_str, base_for_relpath):
+    fpath = Path(fpath_str)
+    try:
+        rel = os.path.relpath(fpath, base_for_relpath)
+    except ValueError:
+        rel = str(fpath.resolve())
+    return rel.replace(os.sep, '/')
+
+def iter_file_contents(paths, workers=DEFAULT_READ_WORKERS, cache=None, stats=None):
+    # Reads files on a thread pool but yields (path, content) strictly in the order given.
+    # Only a bounded window of reads runs ahead, so a slow file holds back output only
+    # at its own position and memory stays proportional to the window, not the tree.
+    read = read_file_content if stats is None else stats.timed_read
+    workers = max(1, int(workers or 1))
+    if workers == 1:
+        for path_str in paths:
+            yield path_str, read(path_str, cache)
+        return
+    window = workers * READ_PREFETCH_FACTOR
+    pending = collections.deque()
+    paths_iter = iter(paths)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
         try:
-            rel = os.path.relpath(fpath, base_for_relpath)
-        except ValueError:
-            rel = str(fpath.resolve())
-
-        fcontent = read_file_content(fpath_str)
-        parts.append("        <file>")
-        parts.append(f"            <path>{rel.replace(os.sep, '/')}</path>")
-        parts.append(f"            <content><![CDATA[{fcontent}]]></content>")
-        parts.append("        </file>")
-    parts.append("    </repository_structure>")
-    parts.append("</context>")
-    return "\n".join(parts)
+            for path_str in paths_iter:
+                pending.append((path_str, executor.submit(read, path_str, cache)))
+                if len(pending) >= window:
+                    break
+            while pending:
+                path_str, future = pending.popleft()
+                next_path = next(paths_iter, None)
+                if next_path is not None:
+                    pending.append((next_path, executor.submit(read, next_path, cache)))
+                yield path_str, future.result()
+        finally:
+            # Generator closed early (e.g. cancelled build): drop reads that have not started
+            for _, future in pending:
+                future.cancel()
 
-def read_file_content(path_str):
+def read_file_content(path_str, cache=None):
     path = Path(path_str)
+    state.redaction_counts.pop(path_str, None)
     try:
-        with open(path, "r", encoding="utf-8", errors="replace") as f:
-            content = f.read()
-        if path.name.lower() in [".env"] or path.name.lower().startswith(".env."):
-            content = obfuscate_env(content)
+        if cache is None:
+            content, masked = load_file_content(path)
+        else:
+            st = os.stat(path_str)
+            entry = cache.get(path_str, st.st_size, st.st_mtime_ns)
+            if entry is None:
+                content, masked = load_file_content(path)
+                cache.put(path_str, st.st_size, st.st_mtime_ns, content, masked)
+            else:
+                content, masked = entry
+        if masked:
+            state.redaction_counts[path_str] = masked
         return content
     except UnicodeDecodeError:
         return f"Binary or non-UTF-8 content not displayed ({path.name})"
     except Exception as e:
         return f"Error reading file ({path.name}): {e}"
 
+def load_file_content(path):
+    # Read and post-process one file into (content, secrets masked); raises on failure so errors are never cached
+    with open(path, "rb") as f:
+        head = f.read(SNIFF_BYTES)
+        is_binary, encoding = classify_content(head)
+        if is_binary and state.data.get("detect_binary_files", True):
+            return f"Binary or non-UTF-8 content not displayed ({path.name})", 0
+        size = os.fstat(f.fileno()).st_size
+        threshold = int(state.data.get("large_file_threshold_kb", DEFAULT_LARGE_FILE_THRESHOLD_KB)) * 1024
+        if threshold and size > threshold:
+            content = summarize_large_file(f, size, encoding)
+        else:
+            content = decode_text(head + f.read(), encoding)
+    return process_text_content(path, content)
+
+def process_text_content(path, content):
+    # Post-processing applied to every decoded file, including older versions used for diffs;
+    # returns (content, secrets masked)
+    if path.name.lower() in [".env"] or path.name.lower().startswith(".env."):
+        content = obfuscate_env(content)
+    redactor = get_redactor()
+    if redactor is not None:
+        return redactor.redact(content)
+    return content, 0
+
+def classify_content(head):
+    # Returns (is_binary, encoding) judged from the first block of a file
+    for bom, encoding in TEXT_BOMS:
+        if head.startswith(bom):
+            return False, encoding
+    if not head:
+        return False, "utf-8"
+    if b"\x00" in head:
+        return True, None
+    if len(head.translate(None, TEXT_CONTROL_BYTES)) * 10 > len(head) * 3:
+        return True, None
+    try:
+        head.decode("utf-8")
+    except UnicodeDecodeError as e:
+        # A multi-byte character cut off by the block boundary is still valid UTF-8
+        if e.start < len(head) - 3:
+            if len(head.translate(None, ASCII_BYTES)) * 10 > len(head) * 3:
+                return True, None
+    return False, "utf-8"
+
+def decode_text(data, encoding):
+    # Same newline handling as reading in text mode
+    text = data.decode(encoding or "utf-8", errors="replace")
+    if "\r" in text:
+        text = text.replace("\r\n", "\n").replace("\r", "\n")
+    return text
+
+def summarize_large_file(f, size, encoding):
+    excerpt = int(state.data.get("large_file_excerpt_kb", DEFAULT_LARGE_FILE_EXCERPT_KB)) * 1024
+    f.seek(0)
+    head = f.read(excerpt)
+    f.seek(max(excerpt, size - excerpt))
+    tail = f.read(excerpt)
+    omitted = size - len(head) - len(tail)
+    parts = [f"[Large file: {size} bytes, showing the first {len(head)} and last {len(tail)} bytes]",
+             decode_text(head, encoding),
+             f"[... {omitted} bytes omitted ...]",
+             decode_text(tail, encoding)]
+    return "\n".join(parts)
+
+def python_skeleton(source):
+    # The module docstring, imports, top-level constants, class and function signatures with
+    # their docstrings, and the same inside top-level if/try blocks; every function body is
+    # replaced by "...". Raises SyntaxError for code ast cannot parse.
+    import ast
+    tree = ast.parse(source)
+    # Split only where ast counts lines; splitlines() would also break at form feeds and the like
+    lines = re.split(r"\r\n?|\n", source)
+    try_nodes = (ast.Try, ast.TryStar) if hasattr(ast, "TryStar") else (ast.Try,)
+
+    def text(l1, c1, l2, c2):
+        # Source between two ast positions (columns are UTF-8 byte offsets)
+        if l1 == l2:
+            return lines[l1 - 1].encode("utf-8")[c1:c2].decode("utf-8", errors="replace")
+        head = lines[l1 - 1].encode("utf-8")[c1:].decode("utf-8", errors="replace")
+        tail = lines[l2 - 1].encode("utf-8")[:c2].decode("utf-8", errors="replace")
+        return "\n".join([head] + lines[l1:l2 - 1] + [tail])
+
+    def opening(node):
+        # (line, byte column) where a statement starts; decorators always begin their line
+        if getattr(node, "decorator_list", None):
+            line = lines[node.decorator_list[0].lineno - 1]
+            return node.decorator_list[0].lineno, len(line.encode("utf-8")) - len(line.lstrip().encode("utf-8"))
+        return node.lineno, node.col_offset
+
+    def starts_line(node):
+        lineno, col = opening(node)
+        return not lines[lineno - 1].encode("utf-8")[:col].strip()
+
+    def lead(node, indent):
+        # The node's own indentation when it starts its line, else the given one
+        lineno, col = opening(node)
+        return lines[lineno - 1].encode("utf-8")[:col].decode("utf-8") if starts_line(node) else indent
+
+    def source(node, indent):
+        # Whole lines when the statement has them to itself (keeping a trailing comment);
+        # a statement sharing a line ("class A: x = 1", "a = 1; b = 2") is cut out exactly
+        rest = lines[node.end_lineno - 1].encode("utf-8")[node.end_col_offset:].strip()
+        if starts_line(node) and (not rest or rest.startswith(b"#")):
+            return lines[node.lineno - 1:node.end_lineno]
+        return [lead(node, indent) + text(node.lineno, node.col_offset, node.end_lineno, node.end_col_offset)]
+
+    def header(lineno, body):
+        # From the start of the line, so decorators keep their "@" and the indentation is preserved
+        return text(lineno, 0, *opening(body[0])).rstrip()
+
+    def is_docstring(node):
+        return isinstance(node, ast.Expr) and isinstance(node.value, ast.Constant) and isinstance(node.value.value, str)
+
+    out = []
+
+    def emit_nested(lineno, body, indent):
+        out.append(header(lineno, body))
+        inner = lead(body[0], indent + "    ")
+        kept = len(out)
+        emit_block(body, inner)
+        if len(out) == kept:
+            out.append(inner + "...")
+
+    def emit_clause(keyword, after, body, indent):
+        # "else:" and "finally:" have no node of their own; find the keyword above the body
+        lineno = opening(body[0])[0]
+        while lineno > after + 1 and not lines[lineno - 1].lstrip().startswith(keyword):
+            lineno -= 1
+        emit_nested(lineno, body, indent)
+
+    def emit_block(nodes, indent):
+        for i, node in enumerate(nodes):
+            if i == 0 and is_docstring(node):
+                out.extend(source(node, indent))
+            elif isinstance(node, (ast.Import, ast.ImportFrom)):
+                out.extend(source(node, indent))
+            elif isinstance(node, (ast.Assign, ast.AnnAssign)):
+                if node.end_lineno - node.lineno >= SKELETON_MAX_CONSTANT_LINES and node.value is not None:
+                    # Cut after the target (not at the value, which may start inside a bracket)
+                    target = node.annotation if isinstance(node, ast.AnnAssign) else node.targets[-1]
+                    out.append(lead(node, indent) + text(node.lineno, node.col_offset, target.end_lineno, target.end_col_offset) + " = ...")
+                else:
+                    out.extend(source(node, indent))
+            elif isinstance(node, ast.ClassDef):
+                emit_nested(opening(node)[0], node.body, indent)
+            elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+                out.append(header(opening(node)[0], node.body))
+                inner = lead(node.body[0], indent + "    ")
+                body = node.body
+                if is_docstring(body[0]):
+                    out.extend(source(body[0], inner))
+                    body = body[1:]
+                if body:
+                    out.append(inner + "...")
+            elif isinstance(node, ast.If):
+                emit_nested(node.lineno, node.body, indent)
+                orelse = node.orelse
+                if len(orelse) == 1 and isinstance(orelse[0], ast.If) and lines[orelse[0].lineno - 1].lstrip().startswith("elif"):
+                    emit_block(orelse, indent)
+                elif orelse:
+                    emit_clause("else", node.body[-1].end_lineno, orelse, indent)
+            elif isinstance(node, try_nodes):
+                emit_nested(node.lineno, node.body, indent)
+                after = node.body[-1].end_lineno
+                for handler in node.handlers:
+                    emit_nested(handler.lineno, handler.body, indent)
+                    after = handler.end_lineno
+                if node.orelse:
+                    emit_clause("else", after, node.orelse, indent)
+                    after = node.orelse[-1].end_lineno
+                if node.finalbody:
+                    emit_clause("finally", after, node.finalbody, indent)
+
+    emit_block(tree.body, "")
+    body = "\n".join(out)
+    shown = body.count("\n") + 1 if out else 0
+    total = len(lines) - (lines[-1] == "")
+    return f"# [skeleton: bodies elided, {shown} lines for {total} source lines]\n" + body + "\n"
+
+# Skeleton extractors: file extension -> function(text) returning the skeleton text. Register them
+# at import time; they also run in worker processes, which import this module afresh.
+SKELETON_EXTRACTORS = {".py": python_skeleton, ".pyi": python_skeleton}
+
+def render_skeleton(ext, content):
+    # Runs in a worker process. Content the extractor cannot parse is returned unchanged.
+    try:
+        return SKELETON_EXTRACTORS[ext](content)
+    except (SyntaxError, ValueError, RecursionError):
+        return content
+
+def skeleton_selector():
+    # Returns is_skeleton(path_str) for the configured globs, or None when skeleton mode is off
+    patterns = [pat for pat in state.data.get("skeleton_patterns", []) if pat]
+    if not patterns:
+        return None
+    base = get_base_for_relpath()
+
+    def is_skeleton(path_str):
+        if os.path.splitext(path_str)[1].lower() not in SKELETON_EXTRACTORS:
+            return False
+        rel = relative_display_path(path_str, base)
+        return any(fnmatch.fnmatch(rel, pat) or fnmatch.fnmatch(os.path.basename(rel), pat) for pat in patterns)
+    return is_skeleton
+
+def get_skeleton_pool():
+    # Shared for the life of the process so repeated builds do not pay the start-up cost again.
+    # "spawn" because builds may run next to GUI and reader threads, which fork does not mix with.
+    if state.skeleton_pool is None:
+        import multiprocessing
+        state.skeleton_pool = concurrent.futures.ProcessPoolExecutor(max_workers=os.cpu_count() or 1,
+                                                                     mp_context=multiprocessing.get_context("spawn"))
+    return state.skeleton_pool
+
+def skeleton_reader(read_contents, is_skeleton):
+    # Wraps a read_contents(paths, workers, cache, stats) function so matching files come out as
+    # skeletons, in the same order. Skeletons are cached by content digest; the parsing of the
+    # others runs in a process pool with a bounded window, or inline for a handful of files.
+    def read(paths, workers=DEFAULT_READ_WORKERS, cache=None, stats=None):
+        paths = list(paths)
+        selected = {p for p in paths if is_skeleton(p)}
+        pool = get_skeleton_pool() if len(selected) >= SKELETON_POOL_MIN_FILES else None
+        window = (os.cpu_count() or 1) * READ_PREFETCH_FACTOR
+        pending = collections.deque()
+        memo = {}
+
+        def submit(path_str, content):
+            ext = os.path.splitext(path_str)[1].lower()
+            key = f"{SKELETON_VERSION}:{ext}:{content_digest(content)}"
+            skeleton = memo.get(key)
+            if skeleton is None and cache is not None:
+                skeleton = cache.get_skeleton(key)
+            if skeleton is not None:
+                return key, skeleton
+            if pool is None:
+                return key, render_skeleton(ext, content)
+            return key, pool.submit(render_skeleton, ext, content)
+
+        def finish(key, result):
+            if isinstance(result, concurrent.futures.Future):
+                result = result.result()
+            if key not in memo:
+                memo[key] = result
+                if cache is not None:
+                    cache.put_skeleton(key, result)
+            return result
+
+        try:
+            for path_str, content in read_contents(paths, workers, cache, stats):
+                if path_str in selected:
+                    pending.append((path_str,) + submit(path_str, content))
+                else:
+                    pending.append((path_str, None, content))
+                while len(pending) > window or (pending and not isinstance(pending[0][2], concurrent.futures.Future)):
+                    path_done, key, result = pending.popleft()
+                    yield path_done, finish(key, result) if key is not None else result
+            while pending:
+                path_done, key, result = pending.popleft()
+                yield path_done, finish(key, result) if key is not None else result
+        finally:
+            for _, _, result in pending:
+                if isinstance(result, concurrent.futures.Future):
+                    result.cancel()
+    return read
+
+def case_variants(*words):
+    # "api_key" -> "api_key|Api_key|API_KEY"
+    return "|".join(dict.fromkeys(v for w in words for v in (w, w[0].upper() + w[1:], w.upper())))
+
+# Built-in secret patterns: name -> (triggers, regex). Every match contains one of its pattern's
+# triggers, and all but "private-key" stay within one line, so only the lines around trigger hits
+# (found at str.find speed) are scanned with the regex. A group named "value" or "value_bare" limits
+# the redaction to that part of the match (the key stays readable); otherwise all of it is replaced.
+SECRET_PATTERNS = {
+    "private-key": (["-----BEGIN"], r"-----BEGIN (?:[A-Z0-9]+ )*PRIVATE KEY(?: BLOCK)?-----[\s\S]*?-----END (?:[A-Z0-9]+ )*PRIVATE KEY(?: BLOCK)?-----"),
+    "aws-access-key": (["AKIA", "ASIA"], r"\b(?:AKIA|ASIA)[0-9A-Z]{16}\b"),
+    "github-token": (["ghp_", "gho_", "ghs_", "github_pat_"], r"\b(?:gh[pos]_[A-Za-z0-9]{36,}|github_pat_[A-Za-z0-9_]{40,})\b"),
+    "slack-token": (["xox"], r"\bxox[abposr]-[A-Za-z0-9-]{10,}"),
+    "google-api-key": (["AIza"], r"\bAIza[0-9A-Za-z_-]{35}"),
+    "stripe-key": (["_live_"], r"\b(?:sk|rk)_live_[0-9A-Za-z]{20,}"),
+    "api-key": (["sk-"], r"\bsk-(?:ant-|proj-)?[A-Za-z0-9_-]{20,}"),
+    "jwt": (["eyJ"], r"\beyJ[A-Za-z0-9_-]{10,}\.eyJ[A-Za-z0-9_-]{10,}\.[A-Za-z0-9_-]{10,}"),
+    "url-password": (["://"], r"(?<=://)[^\s/:@\"']+:(?P<value>[^\s/@\"']+)(?=@)"),
+    # key = "value" / key: value where the key ends in a secret's name (DB_PASSWORD, apiKey, but not
+    # token_type). Unquoted values must mix letters and digits so `TOKEN = DEFAULT_TOKEN` is left alone.
+    "secret-assignment": (["assw", "ASSW", "ecret", "ECRET", "oken", "OKEN", "_key", "Key", "KEY", "apikey", "redential"],
+                          r"(?:" + case_variants("password", "passwd", "secret", "token", "api_key", "apikey", "apiKey", "access_key",
+                                                 "accessKey", "secret_key", "secretKey", "private_key", "privateKey", "auth_key",
+                                                 "credentials", "credential") + r")"
+                          r"\b[\"']?[ \t]*[:=][ \t]*"
+                          r"(?:(?P<quote>[\"'])(?P<value>[^\"'\s$<>{}]{8,})(?P=quote)"
+                          r"|(?P<value_bare>(?=\S*\d)(?=\S*[A-Za-z])[A-Za-z0-9_+/=-]{16,})(?=\s|$))"),
+}
+MULTILINE_SECRET_PATTERNS = {"private-key"}
+
+class Redactor:
+    # The built-in patterns a file triggers are combined into one alternation, so each scanned
+    # stretch of text is matched once however many patterns there are. User patterns have no
+    # triggers and may span lines or rely on inline flags and backreferences, so each is compiled
+    # and run on its own over the whole file. Matches become REDACTION_MARKER + name + "]".
+    def __init__(self, user_patterns=()):
+        self.patterns = [(name, triggers, pattern) for name, (triggers, pattern) in SECRET_PATTERNS.items()]
+        # A bad user pattern fails here rather than in a build
+        self.custom = [re.compile(pattern, re.MULTILINE) for pattern in user_patterns]
+        self.custom_value_groups = [[g for g in ("value", "value_bare") if g in compiled.groupindex] for compiled in self.custom]
+        self.combined = {}
+        self.probes = trigger_probes({t for _, triggers, _ in self.patterns for t in triggers})
+
+    def combined_for(self, active):
+        # One compiled alternation per distinct set of triggered patterns; each pattern's groups
+        # are prefixed so their names stay unique, and its own group tells which one matched
+        entry = self.combined.get(active)
+        if entry is None:
+            branches, names, value_groups = [], {}, {}
+            for i in active:
+                name, _, pattern = self.patterns[i]
+                group = f"p{i}"
+                pattern = re.sub(r"\(\?P([<=])(\w+)", lambda m: f"(?P{m.group(1)}{group}_{m.group(2)}", pattern)
+                branches.append(f"(?P<{group}>{pattern})")
+                names[group] = name
+                value_groups[group] = [f"{group}_value", f"{group}_value_bare"]
+            compiled = re.compile("|".join(branches), re.MULTILINE)
+            value_groups = {group: [g for g in groups if g in compiled.groupindex] for group, groups in value_groups.items()}
+            entry = self.combined[active] = (compiled, names, value_groups)
+        return entry
+
+    def redact(self, content):
+        # Returns the masked content and the number of secrets masked in it
+        # Each distinct trigger is looked for once, not once per pattern that lists it
+        present = set()
+        for probe, group, gate in self.probes:
+            if gate not in content:
+                continue
+            if probe is None:
+                if group[0] in content:
+                    present.add(group[0])
+            elif probe.search(content):
+                # Rare, so the members are simply checked one by one
+                present.update(t for t in group if t in content)
+        active, windows, whole = [], [], False
+        for i, (name, triggers, _) in enumerate(self.patterns):
+            hits = [t for t in triggers if t in present]
+            if hits and name in MULTILINE_SECRET_PATTERNS:
+                active.append(i)
+                whole = True
+            elif hits:
+                active.append(i)
+                if not whole:
+                    windows.extend(trigger_lines(content, hits))
+        count = 0
+        if active:
+            compiled, names, value_groups = self.combined_for(tuple(active))
+            spans = [(0, len(content))] if whole else merge_spans(windows)
+            # The pattern's own group closes last
+            content, count = mask_matches(content, compiled, spans, lambda m: (names[m.lastgroup], value_groups[m.lastgroup]))
+        for compiled, groups in zip(self.custom, self.custom_value_groups):
+            content, masked = mask_matches(content, compiled, [(0, len(content))], lambda m: ("custom", groups))
+            count += masked
+        return content, count
+
+def mask_matches(content, compiled, spans, describe):
+    # Replaces the matches within spans; describe(match) gives the pattern name and the groups
+    # ("value", "value_bare") that limit the redaction when they took part in the match
+    out, last, count = [], 0, 0
+    for start, end in spans:
+        for match in compiled.finditer(content, max(start, last), end):
+            if match.end() == match.start():
+                continue
+            name, value_groups = describe(match)
+            marker = f"{REDACTION_MARKER}{name}]"
+            for value_group in value_groups:
+                if match.start(value_group) >= 0:
+                    out.append(content[last:match.start(value_group)])
+                    out.append(marker)
+                    last = match.end(value_group)
+                    break
+            else:
+                out.append(content[last:match.start()])
+                out.append(marker)
+                last = match.end()
+            count += 1
+    if not out:
+        return content, 0
+    out.append(content[last:])
+    return "".join(out), count
+
+# Letters from most to least common in English text, which code roughly follows
+LETTER_FREQUENCY = "etaoinshrdlcumwfgypbvkjxqz"
+
+def gate_char(text):
+    # The character of text least likely to occur: uppercase first, then the rarest letter
+    return max(text, key=lambda ch: (ch.isupper(), ch.isalpha(), LETTER_FREQUENCY.find(ch.lower())))
+
+def trigger_probes(triggers):
+    # (regex or None, triggers, gate) for the prefilter. A single character is found with memchr,
+    # far faster than a substring search, so a probe whose gate character is absent is skipped.
+    # Triggers that share a first character with two or more others become one regex: its
+    # literal first character lets re skip ahead like str.find, so the group costs one scan.
+    # A single alternation over every trigger has no shared prefix and scans per character,
+    # which is several times slower in CPython's re than the separate substring checks
+    by_first = {}
+    for trigger in sorted(triggers):
+        by_first.setdefault(trigger[0], []).append(trigger)
+    probes = []
+    for first, group in by_first.items():
+        if len(group) >= 3:
+            probes.append((re.compile(re.escape(first) + "(?:" + "|".join(re.escape(t[1:]) for t in group) + ")"), group, first))
+        else:
+            probes.extend((None, [t], gate_char(t)) for t in group)
+    return probes
+
+def trigger_lines(content, triggers):
+    # (start, end) of every line that contains one of the triggers
+    spans = []
+    for trigger in triggers:
+        i = content.find(trigger)
+        while i >= 0:
+            start = content.rfind("\n", 0, i) + 1
+            end = content.find("\n", i)
+            end = len(content) if end < 0 else end
+            spans.append((start, end))
+            i = content.find(trigger, end)
+    return spans
+
+def merge_spans(spans):
+    merged = []
+    for start, end in sorted(spans):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+def redaction_signature():
+    # Part of the content cache signature: cached contents are only reused under the same patterns
+    if not state.data.get("redact_secrets", True):
+        return "|redact=off"
+    joined = "\n".join([pattern for _, pattern in SECRET_PATTERNS.values()] + list(state.data.get("redaction_patterns", [])))
+    return "|redact=" + hashlib.sha1(joined.encode("utf-8")).hexdigest()[:12]
+
+def get_redactor():
+    # Rebuilt only when the patterns change; None when redaction is off
+    if not state.data.get("redact_secrets", True):
+        return None
+    user_patterns = tuple(pat for pat in state.data.get("redaction_patterns", []) if pat)
+    if state.redactor is None or state.redactor[0] != user_patterns:
+        try:
+            state.redactor = (user_patterns, Redactor(user_patterns))
+        except re.error as e:
+            print(f"Warning: Ignoring custom redaction patterns: {e}", file=sys.stderr)
+            state.redactor = (user_patterns, Redactor())
+    return state.redactor[1]
+
+class RedactionReport:
+    # Per-file counts of redacted secrets in one build, as recorded when each file was read
+    # (files served from the content cache bring the count stored with them)
+    def __init__(self):
+        self.counts = {}
+
+    def add(self, rel, count):
+        if count:
+            self.counts[rel] = self.counts.get(rel, 0) + count
+        return count
+
+    def total(self):
+        return sum(self.counts.values())
+
+    def stats_text(self):
+        lines = [f"Redaction: {self.total()} secrets masked in {len(self.counts)} files"]
+        ranked = sorted(self.counts.items(), key=lambda item: (-item[1], item[0]))
+        lines.extend(f"  {count:>5}  {rel}" for rel, count in ranked[:REDACTION_REPORT_FILES])
+        if len(ranked) > REDACTION_REPORT_FILES:
+            lines.append(f"  ... {len(ranked) - REDACTION_REPORT_FILES} more files")
+        return "\n".join(lines)
+
 def obfuscate_env(content):
     lines = []
     for line in content.splitlines():
@@ -172,39 +2278,876 @@ def obfuscate_env(content):
             lines.append(line)
     return "\n".join(lines)
 
-def collect_included_files():
-    files = []
-    for p_str in state.data["included_paths"]:
-        p = Path(p_str)
-        if p.is_file() and p.exists():
-            if should_include_file(p):
-                files.append(str(p.resolve()))
-        elif p.is_dir() and p.exists():
-            for fp in p.rglob("*"):
-                if fp.is_file() and should_include_file(fp):
-                    files.append(str(fp.resolve()))
-    return sorted(list(set(files)))
-
-def should_include_file(path: Path):
-    resolved_path = path.resolve()
-
-    for exc_str in state.data["excluded_paths"]:
-        excp = Path(exc_str).resolve()
+def collect_included_files(progress=None, stats=None):
+    # With stats, the walk and the exclusion checks within it are timed
+    if stats is None:
+        return gather_included_files(progress)
+    matcher = TimedExclusionMatcher.from_state()
+    matcher.stats = stats
+    with stats.stage("walk"):
+        files = gather_included_files(progress, matcher)
+    stats.counts["files_found"] = len(files)
+    return files
+
+def gather_included_files(progress=None, matcher=None):
+    index = get_dir_index()
+    if progress is None:
+        return sorted(set(iter_included_files(matcher, index)))
+    files = set()
+    for fpath in iter_included_files(matcher, index):
+        files.add(fpath)
+        progress.file_discovered(fpath, len(files))
+    return sorted(files)
+
+def iter_included_files(matcher=None, index=None):
+    # Yields resolved file paths as they are found; may yield duplicates when included paths overlap
+    if matcher is None:
+        matcher = ExclusionMatcher.from_state()
+    walk = index.begin(dir_index_signature()) if index is not None else None
+    complete = False
+    roots = []
+    try:
+        for p_str in state.data["included_paths"]:
+            p = Path(p_str)
+            if p.is_file() and p.exists():
+                if should_include_file(p, matcher):
+                    yield str(p.resolve())
+            elif p.is_dir() and p.exists():
+                root_str = str(p.resolve())
+                if matcher.is_excluded_dir(root_str):
+                    continue
+                roots.append(root_str)
+                yield from walk_included_dir(root_str, matcher, index=walk)
+        complete = True
+    finally:
+        if walk is not None:
+            walk.finish(complete, roots)
+
+def walk_included_dir(root_str, matcher, on_dir=None, root_node=None, root_rules=None, index=None):
+    # os.scandir walk that prunes excluded folders before descending into them.
+    # Like Path.rglob, symlinked directories are not followed; symlinked files are.
+    # on_dir(dir_str, trie_node, ignore_rules) is called for every directory visited.
+    # With an index (an IndexedWalk), directories whose mtime is unchanged are not listed.
+    if root_node is None:
+        root_node = matcher.trie_node(root_str)
+    if root_rules is None:
+        root_rules = matcher.ancestor_ignore_rules(root_str)
+    stack = [(root_str, root_node, root_rules)]
+    while stack:
+        dir_str, node, ignore_rules = stack.pop()
+        if index is not None:
+            listed_at = index.stat_dir(dir_str)
+            cached = index.lookup(dir_str, listed_at, ignore_rules)
+            if cached is not None:
+                ignore_rules, files, subdir_names = cached
+                if on_dir is not None:
+                    on_dir(dir_str, node, ignore_rules)
+                yield from files
+                subdirs = []
+                for name in subdir_names:
+                    subdir = matcher.included_subdir(dir_str, name, node, ignore_rules)
+                    if subdir is not None:
+                        subdirs.append(subdir + (ignore_rules,))
+                stack.extend(reversed(subdirs))
+                continue
         try:
-            if excp.is_dir() and str(resolved_path).startswith(str(excp) + os.sep):
+            with os.scandir(dir_str) as it:
+                entries = list(it)
+        except OSError:
+            continue
+        inherited_rules = ignore_rules
+        if matcher.use_ignore_files:
+            ignore_rules = ignore_rules + matcher.load_ignore_rules(dir_str, entries)
+        if on_dir is not None:
+            on_dir(dir_str, node, ignore_rules)
+        subdirs = []
+        files = []
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    subdir = matcher.included_subdir(dir_str, entry.name, node, ignore_rules)
+                    if subdir is not None:
+                        subdirs.append(subdir + (ignore_rules,))
+                elif entry.is_file():
+                    fpath = matcher.included_file(dir_str, entry.name, ignore_rules, entry.is_symlink())
+                    if fpath is not None:
+                        files.append(fpath)
+                        yield fpath
+            except OSError:
+                continue
+        if index is not None:
+            index.record(dir_str, listed_at, inherited_rules, entries, files, [os.path.basename(d[0]) for d in subdirs], matcher)
+        # Reversed so directories are visited in listing order
+        stack.extend(reversed(subdirs))
+
+def should_include_file(path: Path, matcher=None):
+    if matcher is None:
+        matcher = ExclusionMatcher.from_state()
+    if path.suffix.lower() in matcher.excluded_types:
+        return False
+    return not matcher.is_excluded_file(str(path.resolve()))
+
+IGNORE_FILE_NAMES = (".gitignore", ".ignore")
+
+class ExclusionMatcher:
+    # Exclusion rules compiled once per build. Excluded folders live in a prefix trie of
+    # path components, excluded files and extensions in sets, so checking a path is pure
+    # string work with no filesystem calls.
+    TERMINAL = ""
+
+    def __init__(self, excluded_paths, excluded_types, excluded_folder_names, use_ignore_files=True):
+        self.excluded_types = {ext.lower() for ext in excluded_types}
+        self.excluded_folder_names = set(excluded_folder_names)
+        self.excluded_files = set()
+        self.trie = {}
+        self.use_ignore_files = use_ignore_files
+        for exc_str in excluded_paths:
+            try:
+                excp = Path(exc_str).resolve()
+                if excp.is_dir():
+                    self.add_excluded_dir(str(excp))
+                elif excp.is_file():
+                    self.excluded_files.add(str(excp))
+            except Exception:
+                pass
+
+    @classmethod
+    def from_state(cls):
+        return cls(state.data["excluded_paths"], state.data["excluded_types"], DEFAULT_EXCLUDES["folders"],
+                   state.data.get("use_ignore_files", True))
+
+    def add_excluded_dir(self, dir_str):
+        node = self.trie
+        for part in Path(dir_str).parts:
+            node = node.setdefault(part, {})
+        node[self.TERMINAL] = True
+
+    def trie_node(self, dir_str):
+        # Trie node for an (unexcluded) directory, or None once the path has left the trie
+        node = self.trie
+        for part in Path(dir_str).parts:
+            node = node.get(part)
+            if node is None:
+                return None
+        return node
+
+    def is_excluded_dir(self, dir_str):
+        parts = Path(dir_str).parts
+        if any(part in self.excluded_folder_names for part in parts):
+            return True
+        node = self.trie
+        for part in parts:
+            node = node.get(part)
+            if node is None:
                 return False
-            if excp.is_file() and excp == resolved_path:
+            if self.TERMINAL in node:
+                return True
+        return False
+
+    def is_excluded_file(self, path_str):
+        if path_str in self.excluded_files:
+            return True
+        if os.path.splitext(path_str)[1].lower() in self.excluded_types:
+            return True
+        return self.is_excluded_dir(os.path.dirname(path_str))
+
+    def included_subdir(self, dir_str, name, node, ignore_rules):
+        # (path, trie node) for a subdirectory the walk should enter, or None if it is excluded
+        if name in self.excluded_folder_names:
+            return None
+        child_node = node.get(name) if node is not None else None
+        if child_node is not None and self.TERMINAL in child_node:
+            return None
+        child = os.path.join(dir_str, name)
+        if ignore_rules and is_ignored(ignore_rules, child, True):
+            return None
+        return child, child_node
+
+    def included_file(self, dir_str, name, ignore_rules, is_symlink=False):
+        # Resolved path for a file inside an included directory, or None if it is excluded
+        if os.path.splitext(name)[1].lower() in self.excluded_types:
+            return None
+        fpath = os.path.join(dir_str, name)
+        if fpath in self.excluded_files:
+            return None
+        if ignore_rules and is_ignored(ignore_rules, fpath, False):
+            return None
+        if is_symlink:
+            fpath = os.path.realpath(fpath)
+            if self.is_excluded_file(fpath):
+                return None
+        return fpath
+
+    def load_ignore_rules(self, dir_str, entries):
+        rules = ()
+        for entry in entries:
+            if entry.name in IGNORE_FILE_NAMES:
+                try:
+                    if entry.is_file():
+                        rules += (IgnoreRules.from_file(dir_str, entry.path),)
+                except OSError:
+                    pass
+        return tuple(r for r in rules if r.patterns)
+
+    def ancestor_ignore_rules(self, root_str):
+        # Ignore files between the enclosing git work tree and an included folder also apply to it
+        if not self.use_ignore_files:
+            return ()
+        root = Path(root_str)
+        chain = []
+        for parent in root.parents:
+            chain.append(parent)
+            if (parent / ".git").exists():
+                break
+        else:
+            return ()
+        rules = ()
+        for parent in reversed(chain):
+            for name in IGNORE_FILE_NAMES:
+                ignore_file = parent / name
+                if ignore_file.is_file():
+                    rules += (IgnoreRules.from_file(str(parent), str(ignore_file)),)
+        return tuple(r for r in rules if r.patterns)
+
+class TimedExclusionMatcher(ExclusionMatcher):
+    # Used while collecting build stats: accumulates the time spent deciding exclusions during the walk
+    stats = None
+
+    def included_subdir(self, dir_str, name, node, ignore_rules):
+        start = time.perf_counter()
+        try:
+            return ExclusionMatcher.included_subdir(self, dir_str, name, node, ignore_rules)
+        finally:
+            self.stats.add_time("exclusion checks", time.perf_counter() - start)
+
+    def included_file(self, dir_str, name, ignore_rules, is_symlink=False):
+        start = time.perf_counter()
+        try:
+            return ExclusionMatcher.included_file(self, dir_str, name, ignore_rules, is_symlink)
+        finally:
+            self.stats.add_time("exclusion checks", time.perf_counter() - start)
+
+def is_ignored(ignore_rules, path_str, is_dir):
+    # Later (deeper) ignore files win over earlier ones, as in git
+    for rules in reversed(ignore_rules):
+        verdict = rules.match(path_str, is_dir)
+        if verdict is not None:
+            return verdict
+    return False
+
+class IgnoreRules:
+    # Patterns of one .gitignore/.ignore file, matched relative to the folder containing it
+    def __init__(self, base_dir, lines):
+        self.base_prefix = base_dir.rstrip(os.sep) + os.sep
+        self.lines = tuple(lines)
+        self.patterns = []  # (regex, negate, dir_only)
+        for line in lines:
+            compiled = compile_ignore_pattern(line)
+            if compiled is not None:
+                self.patterns.append(compiled)
+
+    @classmethod
+    def from_file(cls, base_dir, file_path):
+        try:
+            with open(file_path, "r", encoding="utf-8", errors="replace") as f:
+                return cls(base_dir, f.read().splitlines())
+        except OSError:
+            return cls(base_dir, [])
+
+    def match(self, path_str, is_dir):
+        if not path_str.startswith(self.base_prefix):
+            return None
+        rel = path_str[len(self.base_prefix):]
+        if os.sep != "/":
+            rel = rel.replace(os.sep, "/")
+        for regex, negate, dir_only in reversed(self.patterns):
+            if dir_only and not is_dir:
+                continue
+            if regex.match(rel):
+                return not negate
+        return None
+
+def compile_ignore_pattern(line):
+    line = line.rstrip("\n\r")
+    if not line.endswith("\\ "):
+        line = line.rstrip(" ")
+    if not line or line.startswith("#"):
+        return None
+    negate = False
+    if line.startswith("!"):
+        negate = True
+        line = line[1:]
+    elif line.startswith("\\#") or line.startswith("\\!"):
+        line = line[1:]
+    dir_only = line.endswith("/")
+    line = line.rstrip("/")
+    if not line:
+        return None
+    anchored = "/" in line
+    line = line.lstrip("/")
+    regex = "" if anchored else "(?:.*/)?"
+    i, n = 0, len(line)
+    while i < n:
+        c = line[i]
+        if line.startswith("**/", i) and (i == 0 or line[i - 1] == "/"):
+            regex += "(?:.*/)?"
+            i += 3
+        elif line.startswith("**", i) and i + 2 == n and (i == 0 or line[i - 1] == "/"):
+            regex += ".*"
+            i += 2
+        elif c == "*":
+            regex += "[^/]*"
+            i += 1
+        elif c == "?":
+            regex += "[^/]"
+            i += 1
+        elif c == "[":
+            j = line.find("]", i + 2)
+            if j == -1:
+                regex += "\\["
+                i += 1
+            else:
+                body = line[i + 1:j]
+                if body.startswith("!"):
+                    body = "^" + body[1:]
+                regex += "[" + body.replace("\\", "\\\\") + "]"
+                i = j + 1
+        elif c == "\\" and i + 1 < n:
+            regex += re.escape(line[i + 1])
+            i += 2
+        else:
+            regex += re.escape(c)
+            i += 1
+    try:
+        return re.compile(regex + "$"), negate, dir_only
+    except re.error:
+        return None
+
+# inotify(7) constants, used through ctypes so watch mode needs no extra package on Linux
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ONLYDIR = 0x1000000
+IN_ISDIR = 0x40000000
+INOTIFY_WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE
+                      | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+INOTIFY_EVENT = struct.Struct("iIII")
+
+class ContextWatcher:
+    # Keeps the included file list and their processed contents in memory between builds.
+    # Directories are watched with inotify where available; otherwise a background thread
+    # re-stats the tree every poll_interval seconds. Either way only created, modified or
+    # deleted files are touched, so a build costs time in proportion to what changed.
+    # Files reached through symlinks and individually included files may live outside the
+    # watched folders; they are re-stat()ed on every build instead.
+    def __init__(self, backend="auto", poll_interval=WATCH_POLL_SECONDS):
+        self.backend = backend
+        self.poll_interval = poll_interval
+        self.lock = threading.RLock()
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.running = False
+        self.inotify = None
+        self.libc = None
+        self.needs_rescan = True
+        self.signature = None
+        self.matcher = None
+        self.files = {}       # path -> (size, mtime_ns) for polled/stat-checked files, None when watched
+        self.contents = {}    # path -> processed content
+        self.versions = {}    # path -> change counter, so reads racing a change are not stored
+        self.watches = {}     # inotify wd -> (dir_str, trie node, ignore rules)
+        self.dir_wds = {}     # dir_str -> wd
+        self.sorted_files = None
+
+    def start(self):
+        if self.running:
+            return
+        if self.backend in ("auto", "inotify"):
+            self.inotify = self.open_inotify()
+        if self.inotify is None and self.backend == "inotify":
+            raise OSError("inotify is not available on this system")
+        self.running = True
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.run, name="context-watcher", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join(timeout=2)
+            self.thread = None
+        if self.inotify is not None:
+            os.close(self.inotify)
+            self.inotify = None
+        with self.lock:
+            self.files, self.contents, self.versions = {}, {}, {}
+            self.watches, self.dir_wds = {}, {}
+            self.sorted_files = None
+            self.needs_rescan = True
+
+    def request_rescan(self):
+        self.needs_rescan = True
+
+    def open_inotify(self):
+        if not sys.platform.startswith("linux"):
+            return None
+        try:
+            import ctypes, ctypes.util
+            libc = ctypes.CDLL(ctypes.util.find_library("c") or None, use_errno=True)
+            fd = libc.inotify_init1(os.O_CLOEXEC)
+            if fd < 0:
+                return None
+            self.libc = libc
+            return fd
+        except (OSError, AttributeError):
+            return None
+
+    def config_signature(self):
+        keys = ("included_paths", "excluded_paths", "excluded_types", "use_ignore_files")
+        return json.dumps([state.data.get(k) for k in keys]) + content_cache_signature()
+
+    def run(self):
+        while not self.stop_event.is_set():
+            try:
+                if self.needs_rescan or self.signature != self.config_signature():
+                    self.rescan()
+                more = self.prefetch()
+                if self.inotify is not None:
+                    ready, _, _ = select.select([self.inotify], [], [], 0 if more else 0.5)
+                    if ready:
+                        with self.lock:
+                            self.drain_inotify()
+                elif not more:
+                    self.stop_event.wait(self.poll_interval)
+                    if not self.stop_event.is_set():
+                        self.poll()
+            except Exception as e:
+                print(f"Warning: Watcher error ({e}), rescanning.", file=sys.stderr)
+                self.needs_rescan = True
+                self.stop_event.wait(self.poll_interval)
+
+    def rescan(self):
+        with self.lock:
+            self.needs_rescan = False
+            self.signature = self.config_signature()
+            self.matcher = ExclusionMatcher.from_state()
+            if self.inotify is not None:
+                for wd in list(self.watches):
+                    self.libc.inotify_rm_watch(self.inotify, wd)
+            self.watches, self.dir_wds = {}, {}
+            old_files, old_contents = self.files, self.contents
+            self.files, self.contents = {}, {}
+            for p_str in state.data["included_paths"]:
+                p = Path(p_str)
+                if p.is_file():
+                    if should_include_file(p, self.matcher):
+                        self.add_file(str(p.resolve()), stat_checked=True)
+                elif p.is_dir():
+                    root_str = str(p.resolve())
+                    if not self.matcher.is_excluded_dir(root_str):
+                        self.add_tree(root_str)
+            # Contents of files whose size and mtime did not change survive a rescan
+            for path_str, stamp in self.files.items():
+                old_stamp = old_files.get(path_str)
+                if path_str in old_contents and stamp is not None and stamp == old_stamp:
+                    self.contents[path_str] = old_contents[path_str]
+            self.sorted_files = None
+
+    def add_tree(self, root_str, root_node=None, root_rules=None):
+        on_dir = self.add_watch if self.inotify is not None else None
+        for fpath in walk_included_dir(root_str, self.matcher, on_dir, root_node, root_rules):
+            # Symlinked files resolve to a path whose directory may not be watched
+            self.add_file(fpath, stat_checked=os.path.dirname(fpath) not in self.dir_wds)
+
+    def add_watch(self, dir_str, node, ignore_rules):
+        wd = self.libc.inotify_add_watch(self.inotify, os.fsencode(dir_str), INOTIFY_WATCH_MASK)
+        if wd < 0:
+            # Usually fs.inotify.max_user_watches exhausted; fall back to polling
+            print("Warning: inotify watch limit reached, watching by polling instead.", file=sys.stderr)
+            os.close(self.inotify)
+            self.inotify = None
+            self.needs_rescan = True
+            return
+        self.watches[wd] = (dir_str, node, ignore_rules)
+        self.dir_wds[dir_str] = wd
+
+    def add_file(self, path_str, stat_checked):
+        stamp = None
+        if stat_checked:
+            try:
+                st = os.stat(path_str)
+                stamp = (st.st_size, st.st_mtime_ns)
+            except OSError:
+                return
+        if path_str not in self.files:
+            self.sorted_files = None
+        self.files[path_str] = stamp
+
+    def invalidate(self, path_str):
+        self.contents.pop(path_str, None)
+        self.versions[path_str] = self.versions.get(path_str, 0) + 1
+
+    def remove_file(self, path_str):
+        if self.files.pop(path_str, False) is not False:
+            self.sorted_files = None
+        self.invalidate(path_str)
+
+    def remove_tree(self, dir_str):
+        prefix = dir_str + os.sep
+        for path_str in [p for p in self.files if p.startswith(prefix)]:
+            self.remove_file(path_str)
+        for sub in [d for d in self.dir_wds if d == dir_str or d.startswith(prefix)]:
+            wd = self.dir_wds.pop(sub)
+            self.watches.pop(wd, None)
+            if self.inotify is not None:
+                self.libc.inotify_rm_watch(self.inotify, wd)
+
+    def drain_inotify(self):
+        # Caller holds the lock. Reads only what is already queued, so it never blocks.
+        while self.inotify is not None and select.select([self.inotify], [], [], 0)[0]:
+            self.handle_inotify_events(os.read(self.inotify, 65536))
+
+    def handle_inotify_events(self, buf):
+        with self.lock:
+            offset = 0
+            while offset + INOTIFY_EVENT.size <= len(buf):
+                wd, mask, _cookie, name_len = INOTIFY_EVENT.unpack_from(buf, offset)
+                name = os.fsdecode(buf[offset + INOTIFY_EVENT.size:offset + INOTIFY_EVENT.size + name_len].rstrip(b"\0"))
+                offset += INOTIFY_EVENT.size + name_len
+                if mask & IN_Q_OVERFLOW:
+                    self.needs_rescan = True
+                    continue
+                watch = self.watches.get(wd)
+                if watch is None:
+                    continue
+                dir_str, node, ignore_rules = watch
+                if mask & IN_IGNORED:
+                    self.watches.pop(wd, None)
+                    if self.dir_wds.get(dir_str) == wd:
+                        del self.dir_wds[dir_str]
+                    continue
+                if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                    if dir_str in (str(Path(p).resolve()) for p in state.data["included_paths"]):
+                        self.needs_rescan = True
+                    continue
+                if not name:
+                    continue
+                if name in IGNORE_FILE_NAMES:
+                    # Ignore rules changed; which files are included has to be recomputed
+                    self.needs_rescan = True
+                    continue
+                path_str = os.path.join(dir_str, name)
+                if mask & IN_ISDIR:
+                    if mask & (IN_DELETE | IN_MOVED_FROM):
+                        self.remove_tree(path_str)
+                    elif mask & (IN_CREATE | IN_MOVED_TO):
+                        subdir = self.matcher.included_subdir(dir_str, name, node, ignore_rules)
+                        if subdir is not None:
+                            self.add_tree(subdir[0], subdir[1], ignore_rules)
+                elif mask & (IN_DELETE | IN_MOVED_FROM):
+                    self.remove_file(path_str)
+                elif mask & (IN_CREATE | IN_MOVED_TO):
+                    fpath = self.matcher.included_file(dir_str, name, ignore_rules, os.path.islink(path_str))
+                    if fpath is not None:
+                        self.add_file(fpath, stat_checked=fpath != path_str)
+                        self.invalidate(fpath)
+                elif path_str in self.files:
+                    self.invalidate(path_str)
+
+    def poll(self):
+        # Polling backend: walk and stat the tree, then apply the differences
+        matcher = ExclusionMatcher.from_state()
+        seen = {}
+        for path_str in iter_included_files(matcher):
+            try:
+                st = os.stat(path_str)
+            except OSError:
+                continue
+            seen[path_str] = (st.st_size, st.st_mtime_ns)
+        with self.lock:
+            for path_str in [p for p in self.files if p not in seen]:
+                self.remove_file(path_str)
+            for path_str, stamp in seen.items():
+                old = self.files.get(path_str, False)
+                if old != stamp:
+                    if old is not False:
+                        self.invalidate(path_str)
+                    self.add_file(path_str, stat_checked=True)
+
+    def prefetch(self):
+        # Read changed files in the background so the next build finds them ready
+        # Returns True while there are more files left to read
+        with self.lock:
+            missing = [p for p in self.files if p not in self.contents][:WATCH_PREFETCH_BATCH]
+            versions = {p: self.versions.get(p, 0) for p in missing}
+        for path_str in missing:
+            if self.stop_event.is_set() or self.needs_rescan:
                 return False
-        except Exception:
-            pass
+            content = read_file_content(path_str)
+            with self.lock:
+                if path_str in self.files and self.versions.get(path_str, 0) == versions[path_str]:
+                    self.contents[path_str] = content
+        return len(missing) == WATCH_PREFETCH_BATCH
 
-    if path.suffix.lower() in state.data["excluded_types"]:
-        return False
+    def check_stat_files(self):
+        # Files outside the watched directories are compared by size and mtime at build time
+        for path_str, stamp in list(self.files.items()):
+            if stamp is None:
+                continue
+            try:
+                st = os.stat(path_str)
+            except OSError:
+                self.remove_file(path_str)
+                continue
+            if (st.st_size, st.st_mtime_ns) != stamp:
+                self.files[path_str] = (st.st_size, st.st_mtime_ns)
+                self.invalidate(path_str)
+
+    def current_files(self):
+        with self.lock:
+            # Changes not yet picked up by the background thread are applied first
+            self.drain_inotify()
+            if self.needs_rescan or self.signature != self.config_signature():
+                self.rescan()
+            elif self.inotify is not None:
+                self.check_stat_files()
+            else:
+                self.poll()
+            if self.sorted_files is None:
+                self.sorted_files = sorted(self.files)
+            return list(self.sorted_files)
+
+    def iter_contents(self, paths, workers=DEFAULT_READ_WORKERS, cache=None, stats=None):
+        # Same contract as iter_file_contents; only files without a kept content are read
+        with self.lock:
+            known = {p: self.contents[p] for p in paths if p in self.contents}
+            versions = {p: self.versions.get(p, 0) for p in paths if p not in known}
+        missing = [p for p in paths if p not in known]
+        fresh = iter_file_contents(missing, workers, cache, stats)
+        for path_str in paths:
+            content = known.get(path_str)
+            if content is None:
+                _, content = next(fresh)
+                with self.lock:
+                    if path_str in self.files and self.versions.get(path_str, 0) == versions[path_str]:
+                        self.contents[path_str] = content
+            yield path_str, content
+
+    def stats_text(self):
+        with self.lock:
+            mode = "inotify" if self.inotify is not None else "polling"
+            return f"Watch mode ({mode}): {len(self.files)} files tracked, {len(self.contents)} kept in memory"
+
+def current_included_files(progress=None):
+    # The watcher's file list when watch mode is on, otherwise a fresh walk
+    if state.watcher is not None and state.watcher.running:
+        return state.watcher.current_files()
+    return collect_included_files(progress)
+
+def set_watch_mode(enabled):
+    if enabled and state.watcher is None:
+        state.watcher = ContextWatcher()
+        state.watcher.start()
+    elif not enabled and state.watcher is not None:
+        state.watcher.stop()
+        state.watcher = None
+
+class PreviewFolder:
+    # `bytes`/`count` cover the included files below this folder, ignoring its own exclusion;
+    # what it contributes to its parent is zero while it is excluded
+    def __init__(self, name, path, parent=None):
+        self.name = name
+        self.path = path
+        self.parent = parent
+        self.folders = {}
+        self.files = []
+        self.bytes = 0
+        self.count = 0
+        self.excluded = False
+
+    def child(self, name):
+        folder = self.folders.get(name)
+        if folder is None:
+            folder = self.folders[name] = PreviewFolder(name, os.path.join(self.path, name), self)
+        return folder
+
+    def entries(self):
+        # Folders first, then files, each alphabetically
+        return [self.folders[n] for n in sorted(self.folders, key=str.lower)] + sorted(self.files, key=lambda f: f.name.lower())
+
+class PreviewFile:
+    def __init__(self, name, path, size, parent):
+        self.name = name
+        self.path = path
+        self.bytes = size
+        self.parent = parent
+        self.excluded = False
+
+class PreviewTree:
+    # Folder hierarchy of an already computed file list with byte totals per folder. The preview
+    # window expands it lazily and toggles exclusions on it without walking the disk again.
+    def __init__(self, files, base):
+        self.root = PreviewFolder("", str(base))
+        for path_str in files:
+            try:
+                size = os.stat(path_str).st_size
+            except OSError:
+                size = 0
+            parts = relative_display_path(path_str, base).split("/")
+            folder = self.root
+            for part in parts[:-1]:
+                folder = folder.child(part)
+            folder.files.append(PreviewFile(parts[-1], path_str, size, folder))
+            while folder is not None:
+                folder.bytes += size
+                folder.count += 1
+                folder = folder.parent
 
-    for part in resolved_path.parts:
-        if part in DEFAULT_EXCLUDES["folders"]:
+    def set_excluded(self, node, excluded):
+        # Flips one node and updates the totals of the folders above it; returns False if unchanged
+        if node.excluded == excluded or node is self.root:
             return False
-    return True
+        node.excluded = excluded
+        sign = -1 if excluded else 1
+        if isinstance(node, PreviewFile):
+            dbytes, dcount = sign * node.bytes, sign
+        else:
+            dbytes, dcount = sign * node.bytes, sign * node.count
+        folder = node.parent
+        while folder is not None:
+            folder.bytes += dbytes
+            folder.count += dcount
+            if folder.excluded:
+                break  # an excluded folder contributes nothing further up
+            folder = folder.parent
+        return True
+
+def format_size(nbytes):
+    for unit in ("B", "KB", "MB"):
+        if nbytes < 1024 or unit == "MB":
+            return f"{nbytes} {unit}" if unit == "B" else f"{nbytes:.1f} {unit}"
+        nbytes /= 1024
+
+class PreviewWindow:
+    # Lazily populated Treeview over a PreviewTree: a folder's entries are inserted when it is
+    # first opened, in chunks, so the window opens instantly however many files there are
+    def __init__(self, master, tree):
+        self.tree = tree
+        self.changed = False
+        self.nodes = {}         # Treeview item -> PreviewFolder / PreviewFile
+        self.placeholders = {}  # item -> (folder, index of the next entry to insert)
+        self.win = tk.Toplevel(master)
+        self.win.title("Effective File List Preview")
+        self.win.geometry("800x550")
+        self.win.transient(master); self.win.grab_set()
+        self.win.columnconfigure(0, weight=1); self.win.rowconfigure(1, weight=1)
+        self.label_summary = ttk.Label(self.win, text="")
+        self.label_summary.grid(row=0, column=0, sticky="w", padx=10, pady=(10,5))
+        frame = ttk.Frame(self.win)
+        frame.grid(row=1, column=0, sticky="nsew", padx=10)
+        frame.columnconfigure(0, weight=1); frame.rowconfigure(0, weight=1)
+        self.view = ttk.Treeview(frame, columns=("files", "size", "tokens"), selectmode="extended")
+        self.view.heading("#0", text="Path")
+        for col, title, width in (("files", "Files", 70), ("size", "Size", 90), ("tokens", "~Tokens", 90)):
+            self.view.heading(col, text=title)
+            self.view.column(col, width=width, anchor="e", stretch=False)
+        self.view.tag_configure("excluded", foreground="gray")
+        self.view.grid(row=0, column=0, sticky="nsew")
+        yscroll = ttk.Scrollbar(frame, orient="vertical", command=self.view.yview)
+        yscroll.grid(row=0, column=1, sticky="ns"); self.view.config(yscrollcommand=yscroll.set)
+        self.view.bind("<<TreeviewOpen>>", lambda e: self.populate(self.view.focus()))
+        self.view.bind("<<TreeviewSelect>>", lambda e: self.load_more_selected())
+        self.view.bind("<space>", lambda e: self.toggle_selected())
+        self.view.bind("<Delete>", lambda e: self.toggle_selected())
+        button_frame = ttk.Frame(self.win)
+        button_frame.grid(row=2, column=0, sticky="ew", padx=10, pady=10)
+        ttk.Label(button_frame, text="Space/Delete or the button toggles the selection; exclusions are saved to Settings.").pack(side="left")
+        ttk.Button(button_frame, text="Close", command=self.close).pack(side="right")
+        ttk.Button(button_frame, text="Exclude / Include Selected", command=self.toggle_selected).pack(side="right", padx=5)
+        self.win.bind('<Escape>', lambda e: self.close())
+        self.win.protocol("WM_DELETE_WINDOW", self.close)
+        self.insert_entries("", tree.root, 0)
+        self.update_summary()
+
+    def values(self, node):
+        if node.excluded:
+            return ("excluded", "", "")
+        count = node.count if isinstance(node, PreviewFolder) else ""
+        return (count, format_size(node.bytes), (node.bytes + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN)
+
+    def insert_entries(self, parent_item, folder, start):
+        entries = folder.entries()
+        for node in entries[start:start + PREVIEW_CHUNK]:
+            is_folder = isinstance(node, PreviewFolder)
+            item = self.view.insert(parent_item, "end", text=node.name + ("/" if is_folder else ""), values=self.values(node),
+                                    tags=("excluded",) if node.excluded else ())
+            self.nodes[item] = node
+            if is_folder and (node.folders or node.files):
+                self.placeholders[self.view.insert(item, "end", text="")] = (node, 0)
+        if start + PREVIEW_CHUNK < len(entries):
+            more = self.view.insert(parent_item, "end", text=f"... {len(entries) - start - PREVIEW_CHUNK} more (select to load)")
+            self.placeholders[more] = (folder, start + PREVIEW_CHUNK)
+
+    def populate(self, item):
+        # Replaces an opened folder's dummy child with its first chunk of entries
+        children = self.view.get_children(item)
+        if len(children) == 1 and children[0] in self.placeholders:
+            folder, start = self.placeholders.pop(children[0])
+            self.view.delete(children[0])
+            self.insert_entries(item, folder, start)
+
+    def load_more_selected(self):
+        for item in self.view.selection():
+            placeholder = self.placeholders.get(item)
+            if placeholder is not None and self.view.item(item, "text"):
+                parent = self.view.parent(item)
+                del self.placeholders[item]
+                self.view.delete(item)
+                self.insert_entries(parent, *placeholder)
+                return
+
+    def toggle_selected(self):
+        nodes = [self.nodes[i] for i in self.view.selection() if i in self.nodes]
+        if not nodes: return
+        exclude = not all(n.excluded for n in nodes)
+        excluded_paths = list(state.data["excluded_paths"])
+        for node in nodes:
+            if not self.tree.set_excluded(node, exclude): continue
+            p_str = Path(node.path).as_posix()
+            if exclude and p_str not in excluded_paths: excluded_paths.append(p_str)
+            elif not exclude and p_str in excluded_paths: excluded_paths.remove(p_str)
+            self.changed = True
+        state.data["excluded_paths"] = sorted(set(excluded_paths))
+        self.refresh()
+
+    def refresh(self):
+        # Only inserted items exist, so updating all of them stays cheap
+        for item, node in self.nodes.items():
+            self.view.item(item, values=self.values(node), tags=("excluded",) if node.excluded else ())
+        self.update_summary()
+
+    def update_summary(self):
+        root = self.tree.root
+        if not root.count:
+            self.label_summary.config(text="No files would be included...")
+            return
+        self.label_summary.config(text=f"{root.count} files will be included, {format_size(root.bytes)}, "
+                                       f"~{(root.bytes + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN} tokens (estimated from size)")
+
+    def close(self):
+        if self.changed:
+            state.save_config()
+            if state.watcher is not None: state.watcher.request_rescan()
+        self.win.destroy()
 
 class ContextBuilderGUI:
     def __init__(self, master):
@@ -235,7 +3178,7 @@ class ContextBuilderGUI:
         self.list_included.bind("<Delete>", lambda event: self.remove_included())
 
         files_buttons_frame = ttk.Frame(files_labelframe)
-        files_buttons_frame.grid(row=3, column=0, columnspan=2, sticky="w", pady=(0,5))
+        files_buttons_frame.grid(row=3, column=0, sticky="w", pady=(0,5))
         self.btn_included_add_files = ttk.Button(files_buttons_frame, text="Add Files...", command=self.add_files)
         self.btn_included_add_files.pack(side="left", padx=(0,5))
         self.btn_included_add_folder = ttk.Button(files_buttons_frame, text="Add Folder...", command=self.add_folder)
@@ -244,6 +3187,19 @@ class ContextBuilderGUI:
         self.btn_included_remove.pack(side="left", padx=5)
         self.btn_included_clear = ttk.Button(files_buttons_frame, text="Clear All", command=self.clear_included)
         self.btn_included_clear.pack(side="left", padx=5)
+        workspace_frame = ttk.Frame(files_labelframe)
+        workspace_frame.grid(row=3, column=1, sticky="e", pady=(0,5))
+        ttk.Label(workspace_frame, text="Workspace:").pack(side="left")
+        self.combo_workspace = ttk.Combobox(workspace_frame, state="readonly", width=16)
+        self.combo_workspace.pack(side="left", padx=5)
+        self.combo_workspace.bind("<<ComboboxSelected>>", lambda event: self.select_workspace(self.combo_workspace.get()))
+        self.btn_workspace_new = ttk.Button(workspace_frame, text="New...", command=self.new_workspace)
+        self.btn_workspace_new.pack(side="left")
+        self.btn_workspace_delete = ttk.Button(workspace_frame, text="Delete", command=self.delete_workspace)
+        self.btn_workspace_delete.pack(side="left", padx=(5,0))
+        # Everything that changes state.data["included_paths"]; locked while a build reads them
+        self.selection_buttons = (self.btn_included_add_files, self.btn_included_add_folder, self.btn_included_remove, self.btn_included_clear,
+                                  self.btn_workspace_new, self.btn_workspace_delete)
         files_labelframe.rowconfigure(1, weight=1)
 
         instr_labelframe = ttk.Labelframe(self.frame_main, text="2. Task Instructions (Optional)")
@@ -271,6 +3227,21 @@ class ContextBuilderGUI:
         self.btn_preview.grid(row=0, column=1, padx=(0,10))
         self.btn_copy = ttk.Button(self.bottom_frame, text="Generate & Copy Context to Clipboard", command=self.copy_latest, style="Accent.TButton")
         self.btn_copy.grid(row=0, column=2, sticky="ew", ipady=5)
+        self.btn_save_file = ttk.Button(self.bottom_frame, text="Save to File...", command=self.save_context_to_file)
+        self.btn_save_file.grid(row=0, column=3, padx=(5,0))
+        self.btn_build_stats = ttk.Button(self.bottom_frame, text="Build Stats", command=self.show_build_stats)
+        self.btn_build_stats.grid(row=0, column=4, padx=(5,0))
+        # Progress row, only shown while a build runs on the worker thread
+        self.progress_bar = ttk.Progressbar(self.bottom_frame, mode="determinate", maximum=100)
+        self.progress_bar.grid(row=1, column=0, columnspan=4, sticky="ew", pady=(8,0))
+        self.btn_cancel_build = ttk.Button(self.bottom_frame, text="Cancel", command=self.cancel_build)
+        self.btn_cancel_build.grid(row=1, column=4, padx=(5,0), pady=(8,0))
+        self.label_progress = ttk.Label(self.bottom_frame, text="", anchor="w")
+        self.label_progress.grid(row=2, column=0, columnspan=5, sticky="ew")
+        for w in (self.progress_bar, self.btn_cancel_build, self.label_progress): w.grid_remove()
+        self.build_thread = None
+        self.build_progress = None
+        self.build_queue = queue.Queue()
 
         self.frame_main.rowconfigure(0, weight=3)
         self.frame_main.rowconfigure(1, weight=2)
@@ -293,10 +3264,34 @@ class ContextBuilderGUI:
         for p_str in state.data["included_paths"]:
             self.list_included.insert(tk.END, p_str)
         self.label_item_count.config(text=f"Items: {self.list_included.size()}")
+        self.combo_workspace.config(values=state.workspace_names())
+        self.combo_workspace.set(state.data["active_workspace"])
+        if state.watcher is not None: state.watcher.request_rescan()
+
+    def select_workspace(self, name):
+        if not name or name == state.data["active_workspace"]: return
+        state.switch_workspace(name, create=True)
+        state.save_config()
+        self.update_list_included()
+
+    def new_workspace(self):
+        name = simpledialog.askstring("New Workspace", "Workspace name:", parent=self.master)
+        if name and name.strip():
+            self.select_workspace(name.strip())
+
+    def delete_workspace(self):
+        name = state.data["active_workspace"]
+        if not messagebox.askyesno("Delete Workspace", f"Delete workspace '{name}' and its list of files and folders?", parent=self.master): return
+        state.delete_workspace(name)
+        store = get_snapshot_store()
+        if store is not None: store.drop_workspaces_except(state.workspace_names())
+        state.save_config()
+        self.update_list_included()
 
     def files_dropped(self, files_bytes_list): # windnd passes a list of byte strings
         if not (IS_WINDOWS and windnd): # Should not be called if not windows, but defensive
             return
+        if self.build_thread is not None: return # the running build reads the included paths
         added_any = False
         current_paths_set = set(state.data["included_paths"])
         for f_bytes in files_bytes_list:
@@ -337,6 +3332,7 @@ class ContextBuilderGUI:
                 self.update_list_included()
 
     def remove_included(self):
+        if self.build_thread is not None: return # also bound to the Delete key, which is not disabled during a build
         selected_indices = self.list_included.curselection()
         if not selected_indices: return
         selected_values = [self.list_included.get(i) for i in selected_indices]
@@ -354,70 +3350,267 @@ class ContextBuilderGUI:
         if not state.data["included_paths"]:
             messagebox.showinfo("Preview", "No files/folders selected to preview.", parent=self.master)
             return
-        original_text = self.btn_preview.cget("text")
-        self.btn_preview.config(text="Generating Preview...", state=tk.DISABLED)
-        self.master.update_idletasks()
-        try:
-            effective_files = collect_included_files()
-            preview_win = tk.Toplevel(self.master)
-            preview_win.title("Effective File List Preview")
-            preview_win.geometry("700x500")
-            preview_win.transient(self.master); preview_win.grab_set()
-            preview_win.columnconfigure(0, weight=1); preview_win.rowconfigure(0, weight=1)
-            st_frame = ttk.Frame(preview_win); st_frame.grid(row=0, column=0, sticky="nsew", padx=10, pady=10)
-            st_frame.rowconfigure(0, weight=1); st_frame.columnconfigure(0, weight=1)
-            st = scrolledtext.ScrolledText(st_frame, wrap=tk.WORD, relief=tk.SUNKEN, borderwidth=1)
-            st.grid(row=0, column=0, sticky="nsew")
-            yscroll = ttk.Scrollbar(st_frame, orient="vertical", command=st.yview)
-            yscroll.grid(row=0, column=1, sticky="ns"); st.config(yscrollcommand=yscroll.set)
-            if not effective_files: st.insert(tk.END, "No files would be included...")
-            else:
-                st.insert(tk.END, f"The following {len(effective_files)} files will be included:\n\n")
-                base_for_relpath = Path.cwd()
-                if state.data["included_paths"]:
-                    try:
-                        abs_paths = [Path(p).resolve() for p in state.data["included_paths"]]
-                        if abs_paths:
-                            common_ancestors = [p.parent if p.is_file() else p for p in abs_paths]
-                            if common_ancestors:
-                                common = Path(os.path.commonpath(common_ancestors))
-                                if common and all(str(p).startswith(str(common)) for p in abs_paths):
-                                    base_for_relpath = common
-                    except Exception: pass
-                for f_path_str in effective_files:
-                    f_path = Path(f_path_str)
-                    try: rel = os.path.relpath(f_path, base_for_relpath)
-                    except ValueError: rel = str(f_path.resolve())
-                    st.insert(tk.END, rel.replace(os.sep, '/') + "\n")
-            st.config(state=tk.DISABLED)
-            close_btn = ttk.Button(preview_win, text="Close", command=preview_win.destroy)
-            close_btn.grid(row=1, column=0, pady=(0,10), padx=10, sticky="e")
-            preview_win.bind('<Escape>', lambda e: preview_win.destroy())
-        except Exception as e: messagebox.showerror("Preview Error", f"Error: {e}", parent=self.master)
-        finally: self.btn_preview.config(text=original_text, state=tk.NORMAL)
+        self.run_build_in_background(self.btn_preview, "Generating Preview...", "Preview Error",
+                                     lambda progress: PreviewTree(current_included_files(progress), get_base_for_relpath()), self.show_preview_window)
 
-    def copy_latest(self):
+    def show_preview_window(self, preview_tree):
+        PreviewWindow(self.master, preview_tree)
+
+    def show_build_stats(self):
+        stats = state.last_build_stats
+        if stats is None:
+            messagebox.showinfo("Build Stats", "No build statistics yet.\n\nTurn on \"Collect build statistics\" in Settings, then generate or save a context.", parent=self.master)
+            return
+        report = stats.report(top=BUILD_STATS_PANEL_ROWS)
+        stats_win = tk.Toplevel(self.master)
+        stats_win.title(f"Build Stats ({report['started_at']})")
+        stats_win.geometry("700x500")
+        stats_win.transient(self.master)
+        stats_win.columnconfigure(0, weight=1); stats_win.rowconfigure(1, weight=1)
+        counts = report["counts"]
+        summary = (f"{counts.get('files_found', counts.get('files_emitted', 0))} files found, {counts.get('files_emitted', 0)} emitted, "
+                   f"{counts.get('files_read', 0)} read from disk or cache, ~{report['total_tokens']} tokens ({report['tokenizer']})")
+        ttk.Label(stats_win, text=summary).grid(row=0, column=0, sticky="w", padx=10, pady=(10,5))
+        notebook = ttk.Notebook(stats_win)
+        notebook.grid(row=1, column=0, sticky="nsew", padx=10)
+        total_tokens = report["total_tokens"] or 1
+        tabs = [("Stages", ("Stage", "Seconds"), [(name, f"{sec:.3f}") for name, sec in report["stages"].items()]),
+                ("Tokens by Folder", ("Folder", "Tokens", "Share"),
+                 [(name, tokens, f"{100 * tokens / total_tokens:.1f}%") for name, tokens in list(report["tokens_by_directory"].items())[:BUILD_STATS_PANEL_ROWS]]),
+                ("Largest Files", ("File", "Bytes"), [(f["path"], f["bytes"]) for f in report["largest_files"]]),
+                ("Slowest Reads", ("File", "Milliseconds"), [(f["path"], f"{f['seconds'] * 1000:.1f}") for f in report["slowest_files"]])]
+        for title, columns, rows in tabs:
+            frame = ttk.Frame(notebook)
+            frame.columnconfigure(0, weight=1); frame.rowconfigure(0, weight=1)
+            tree = ttk.Treeview(frame, columns=columns, show="headings")
+            for i, col in enumerate(columns):
+                tree.heading(col, text=col)
+                tree.column(col, anchor="w" if i == 0 else "e", width=400 if i == 0 else 100, stretch=(i == 0))
+            for row in rows: tree.insert("", "end", values=row)
+            tree.grid(row=0, column=0, sticky="nsew")
+            yscroll = ttk.Scrollbar(frame, orient="vertical", command=tree.yview)
+            yscroll.grid(row=0, column=1, sticky="ns"); tree.config(yscrollcommand=yscroll.set)
+            notebook.add(frame, text=title)
+        button_frame = ttk.Frame(stats_win)
+        button_frame.grid(row=2, column=0, sticky="e", padx=10, pady=10)
+        ttk.Button(button_frame, text="Save JSON...", command=lambda: self.save_build_stats_json(stats, stats_win)).pack(side="left", padx=(0,5))
+        ttk.Button(button_frame, text="Close", command=stats_win.destroy).pack(side="left")
+        stats_win.bind('<Escape>', lambda e: stats_win.destroy())
+
+    def save_build_stats_json(self, stats, parent):
+        out_path = filedialog.asksaveasfilename(title="Save build stats as", defaultextension=".json",
+                                                filetypes=[("JSON files", "*.json"), ("All files", "*.*")], parent=parent)
+        if not out_path: return
+        try: stats.write_json(out_path)
+        except OSError as e: messagebox.showerror("Build Stats", f"Could not save: {e}", parent=parent)
+
+    def get_context_inputs(self):
         task_instructions = self.text_instructions.get("1.0", "end-1c").strip()
         error_output = self.text_error.get("1.0", "end-1c").strip()
         if not state.data["included_paths"] and not task_instructions and not error_output and not (state.data.get("use_custom_instructions") and (state.data.get("custom_instructions_url") or state.load_custom_instructions_cache())):
             messagebox.showwarning("Empty Context", "Nothing to build context from.")
+            return None
+        return task_instructions, error_output
+
+    def copy_latest(self):
+        inputs = self.get_context_inputs()
+        if inputs is None: return
+        task_instructions, error_output = inputs
+
+        if sharding_enabled():
+            # Shards are written as they are produced, then handed to the clipboard one at a time
+            work = lambda progress: write_shards(state.config_dir / SHARD_DIR, task_instructions, error_output, progress)
+            self.run_build_in_background(self.btn_copy, "Generating...", "Error Building Context", work, self.show_shard_copier)
             return
-        original_text = self.btn_copy.cget("text")
-        self.btn_copy.config(text="Generating...", state=tk.DISABLED)
-        self.master.update_idletasks()
+
+        def work(progress):
+            # The clipboard needs one string, so the stream is collected once into a buffer
+            buf = io.StringIO()
+            write_context(buf, task_instructions, error_output, progress)
+            xml = buf.getvalue()
+            buf.close()
+            return xml
+
+        self.run_build_in_background(self.btn_copy, "Generating...", "Error Building Context", work, self.copy_to_clipboard)
+
+    def copy_to_clipboard(self, xml):
+        import pyperclip
         try:
-            xml = build_context(task_instructions, error_output)
-            pyperclip.copy(xml)
-            messagebox.showinfo("Copied", "Context copied to clipboard!")
+            copy_text_to_clipboard(xml)
+            messagebox.showinfo("Copied", "Context copied to clipboard!" + self.build_summary_suffix())
         except pyperclip.PyperclipException as e:
             messagebox.showerror("Clipboard Error", f"Could not copy: {e}\n\nContext printed to console.", parent=self.master)
             print("--BEGIN CONTEXT--\n", xml, "\n--END CONTEXT--")
-        except Exception as e:
-            messagebox.showerror("Error Building Context", f"Error: {e}", parent=self.master)
-            print(f"Error building context: {e}")
-        finally: self.btn_copy.config(text=original_text, state=tk.NORMAL)
+
+    def show_shard_copier(self, paths):
+        # Copies the first shard right away; "Copy Next Shard" moves through the rest
+        shard_win = tk.Toplevel(self.master)
+        shard_win.title("Sharded Context")
+        shard_win.transient(self.master)
+        shard_win.resizable(False, False)
+        label = ttk.Label(shard_win, justify=tk.LEFT)
+        label.grid(row=0, column=0, columnspan=3, sticky="w", padx=10, pady=10)
+        position = {"next": 0}
+
+        def copy_next():
+            import pyperclip
+            path = paths[position["next"]]
+            try:
+                copy_text_to_clipboard(path.read_text(encoding="utf-8"))
+            except (OSError, pyperclip.PyperclipException) as e:
+                messagebox.showerror("Clipboard Error", f"Could not copy {path.name}: {e}", parent=shard_win)
+                return
+            position["next"] += 1
+            done = position["next"] >= len(paths)
+            label.config(text=f"Shard {position['next']} of {len(paths)} copied to the clipboard ({path.stat().st_size / 1024:.1f} KB)."
+                              + ("\nAll shards copied." if done else "\nPaste it, then copy the next one.")
+                              + (self.build_summary_suffix() if position["next"] == 1 else ""))
+            btn_next.config(state=tk.DISABLED if done else tk.NORMAL)
+
+        btn_next = ttk.Button(shard_win, text="Copy Next Shard", command=copy_next, style="Accent.TButton")
+        btn_next.grid(row=1, column=0, sticky="w", padx=10, pady=(0,10))
+        ttk.Label(shard_win, text=f"Shards are in {paths[0].parent}" if paths else "").grid(row=1, column=1, sticky="w", padx=5, pady=(0,10))
+        ttk.Button(shard_win, text="Close", command=shard_win.destroy).grid(row=1, column=2, sticky="e", padx=10, pady=(0,10))
+        shard_win.bind('<Escape>', lambda e: shard_win.destroy())
+        copy_next()
+
+    def save_context_to_file(self):
+        inputs = self.get_context_inputs()
+        if inputs is None: return
+        task_instructions, error_output = inputs
+        if sharding_enabled():
+            out_dir = filedialog.askdirectory(title="Save shards to folder", parent=self.master)
+            if not out_dir: return
+            work = lambda progress: write_shards(out_dir, task_instructions, error_output, progress)
+            self.run_build_in_background(self.btn_save_file, "Saving...", "Error Saving Context", work,
+                                         lambda paths: messagebox.showinfo("Saved", f"{len(paths)} shards saved to:\n{out_dir}" + self.build_summary_suffix(), parent=self.master))
+            return
+        serializer = get_serializer()
+        out_path = filedialog.asksaveasfilename(title="Save context as", defaultextension=serializer.extension,
+                                                filetypes=[(f"{serializer.name} files", "*" + serializer.extension), ("All files", "*.*")], parent=self.master)
+        if not out_path: return
+
+        def work(progress):
+            # Written next to the target and renamed at the end, so a cancelled or failed build leaves nothing behind
+            partial_path = out_path + ".partial"
+            try:
+                with open(partial_path, "w", encoding="utf-8", newline="") as f:
+                    write_context(f, task_instructions, error_output, progress, serializer)
+                os.replace(partial_path, out_path)
+            except BaseException:
+                try: os.remove(partial_path)
+                except OSError: pass
+                raise
+            return out_path
+
+        self.run_build_in_background(self.btn_save_file, "Saving...", "Error Saving Context", work,
+                                     lambda path: messagebox.showinfo("Saved", f"Context saved to:\n{path}" + self.build_summary_suffix(), parent=self.master))
+
+    def run_build_in_background(self, busy_button, busy_text, error_title, work, on_done):
+        # work(progress) runs on a worker thread and must not touch Tk; it reports through
+        # self.build_queue, which the Tk thread drains in poll_build_queue. on_done(result)
+        # runs on the Tk thread. A cancelled build's result is simply dropped.
+        if self.build_thread is not None: return
+        self.build_queue = queue.Queue()
+        build_queue = self.build_queue
+        progress = BuildProgress(report=lambda snapshot: build_queue.put(("progress", snapshot)))
+
+        def target():
+            try:
+                build_queue.put(("done", work(progress)))
+            except BuildCancelled:
+                build_queue.put(("cancelled", None))
+            except Exception as e:
+                build_queue.put(("error", e))
+
+        self.build_progress = progress
+        self.build_callbacks = (busy_button, busy_button.cget("text"), error_title, on_done)
+        busy_button.config(text=busy_text)
+        for btn in (self.btn_preview, self.btn_copy, self.btn_save_file, self.btn_settings) + self.selection_buttons: btn.config(state=tk.DISABLED)
+        self.combo_workspace.config(state=tk.DISABLED)
+        self.progress_bar.config(mode="indeterminate", value=0); self.progress_bar.start(15)
+        self.btn_cancel_build.config(state=tk.NORMAL)
+        self.label_progress.config(text="Scanning...")
+        for w in (self.progress_bar, self.btn_cancel_build, self.label_progress): w.grid()
+        self.build_thread = threading.Thread(target=target, name="context-build", daemon=True)
+        self.build_thread.start()
+        self.master.after(BUILD_POLL_MS, self.poll_build_queue)
+
+    def poll_build_queue(self):
+        try:
+            while True:
+                kind, payload = self.build_queue.get_nowait()
+                if kind == "progress":
+                    self.show_build_progress(payload)
+                    continue
+                busy_button, original_text, error_title, on_done = self.build_callbacks
+                self.finish_build(busy_button, original_text)
+                if kind == "done":
+                    on_done(payload)
+                elif kind == "error":
+                    messagebox.showerror(error_title, f"Error: {payload}", parent=self.master)
+                    print(f"{error_title}: {payload}")
+                return
+        except queue.Empty:
+            pass
+        self.master.after(BUILD_POLL_MS, self.poll_build_queue)
+
+    def show_build_progress(self, snap):
+        if snap["files_total"]:
+            if str(self.progress_bar.cget("mode")) != "determinate":
+                self.progress_bar.stop(); self.progress_bar.config(mode="determinate")
+            self.progress_bar.config(value=100.0 * snap["files_read"] / snap["files_total"])
+            text = f"{snap['stage']} {snap['files_read']}/{snap['files_total']} files, {snap['bytes_read'] / 1048576:.1f} MB"
+        else:
+            text = f"{snap['stage']}... {snap['files_discovered']} files found"
+        current = snap["current_path"]
+        if len(current) > 70: current = "..." + current[-67:]
+        self.label_progress.config(text=f"{text}  {current}")
+
+    def finish_build(self, busy_button, original_text):
+        self.build_thread = None
+        self.build_progress = None
+        self.progress_bar.stop()
+        for w in (self.progress_bar, self.btn_cancel_build, self.label_progress): w.grid_remove()
+        for btn in (self.btn_preview, self.btn_copy, self.btn_save_file, self.btn_settings) + self.selection_buttons: btn.config(state=tk.NORMAL)
+        self.combo_workspace.config(state="readonly")
+        busy_button.config(text=original_text)
+
+    def cancel_build(self):
+        if self.build_progress is not None:
+            self.build_progress.cancel()
+            self.btn_cancel_build.config(state=tk.DISABLED)
+            self.label_progress.config(text="Cancelling...")
+
+    def build_summary_suffix(self):
+        sections = []
+        if state.content_cache is not None and state.data.get("use_content_cache", True):
+            sections.append(state.content_cache.stats_text())
+            print(sections[-1])
+        if state.watcher is not None:
+            sections.append(state.watcher.stats_text())
+            print(sections[-1])
+        elif state.dir_index is not None and state.data.get("use_dir_index", True):
+            sections.append(state.dir_index.stats_text())
+            print(sections[-1])
+        if state.last_dedup is not None:
+            sections.append(state.last_dedup.stats_text())
+            print(sections[-1])
+        if state.last_redactions is not None and state.last_redactions.counts:
+            sections.append(state.last_redactions.stats_text())
+            print(sections[-1])
+        if state.last_budget_plan is not None:
+            report = state.last_budget_plan.report_text()
+            lines = report.splitlines()
+            if len(lines) > BUDGET_REPORT_DIALOG_LINES:
+                lines = lines[:BUDGET_REPORT_DIALOG_LINES] + [f"... {len(lines) - BUDGET_REPORT_DIALOG_LINES} more (full report printed to console)"]
+            print(report)
+            sections.append("\n".join(lines))
+        return "".join("\n\n" + section for section in sections)
 
     def on_closing(self):
+        if self.build_progress is not None: self.build_progress.cancel()
+        set_watch_mode(False)
         state.save_config(); self.master.destroy()
 
     def open_settings(self):
@@ -441,6 +3634,12 @@ class ContextBuilderGUI:
         self.entry_url.insert(0, state.data.get("custom_instructions_url", ""))
         btn_test_url = ttk.Button(custom_instr_lf, text="Test URL", command=self.test_url)
         btn_test_url.grid(row=1, column=2, sticky="w", padx=(0,5), pady=2)
+        ttl_frame = ttk.Frame(custom_instr_lf)
+        ttl_frame.grid(row=2, column=0, columnspan=3, sticky="w", padx=5, pady=(0,5))
+        ttk.Label(ttl_frame, text="Re-check URL after (minutes):").pack(side="left")
+        self.var_custom_ttl = tk.IntVar(value=state.data.get("custom_instructions_ttl_minutes", DEFAULT_CUSTOM_INSTRUCTIONS_TTL_MINUTES))
+        ttk.Spinbox(ttl_frame, from_=0, to=100000, width=7, textvariable=self.var_custom_ttl).pack(side="left", padx=5)
+        ttk.Label(ttl_frame, text="(the cached copy is used in between and if the URL is unreachable)").pack(side="left")
 
         excluded_types_lf = ttk.Labelframe(settings_frame, text="Excluded File Extensions")
         excluded_types_lf.grid(row=1, column=0, columnspan=3, sticky="ew", pady=5, padx=5)
@@ -455,6 +3654,22 @@ class ContextBuilderGUI:
         ttk.Button(ext_button_frame, text="Add Extension...", command=self.add_ext).pack(side="left")
         ttk.Button(ext_button_frame, text="Remove Selected", command=self.remove_ext).pack(side="left", padx=5)
         ttk.Label(excluded_types_lf, text="Note: Default folder exclusions (e.g. '.git', 'node_modules')\nand some default extensions (e.g. '.exe', '.dll') are always active.", justify=tk.LEFT, relief=tk.SUNKEN, padding=5).grid(row=2, column=0, columnspan=3, sticky="ew", padx=5, pady=5)
+        content_frame = ttk.Frame(excluded_types_lf)
+        content_frame.grid(row=3, column=0, columnspan=3, sticky="w", padx=5, pady=(0,5))
+        self.var_detect_binary = tk.BooleanVar(value=state.data.get("detect_binary_files", True))
+        ttk.Checkbutton(content_frame, text="Detect binary files by content and leave them out", variable=self.var_detect_binary).grid(row=0, column=0, columnspan=4, sticky="w")
+        ttk.Label(content_frame, text="Summarize files larger than (KB, 0 = never):").grid(row=1, column=0, sticky="w")
+        self.var_large_file_kb = tk.IntVar(value=state.data.get("large_file_threshold_kb", DEFAULT_LARGE_FILE_THRESHOLD_KB))
+        ttk.Spinbox(content_frame, from_=0, to=10000000, width=8, textvariable=self.var_large_file_kb).grid(row=1, column=1, sticky="w", padx=5)
+        ttk.Label(content_frame, text="Head/tail excerpt (KB):").grid(row=1, column=2, sticky="w", padx=(10,0))
+        self.var_excerpt_kb = tk.IntVar(value=state.data.get("large_file_excerpt_kb", DEFAULT_LARGE_FILE_EXCERPT_KB))
+        ttk.Spinbox(content_frame, from_=1, to=1024, width=5, textvariable=self.var_excerpt_kb).grid(row=1, column=3, sticky="w", padx=5)
+        self.var_redact_secrets = tk.BooleanVar(value=state.data.get("redact_secrets", True))
+        ttk.Checkbutton(content_frame, text="Mask secrets (API keys, tokens, passwords, private keys) in all files", variable=self.var_redact_secrets).grid(row=2, column=0, columnspan=4, sticky="w")
+        ttk.Label(content_frame, text="Extra secret patterns (regex, one per line):").grid(row=3, column=0, columnspan=4, sticky="w")
+        self.text_redaction_patterns = tk.Text(content_frame, width=60, height=3)
+        self.text_redaction_patterns.grid(row=4, column=0, columnspan=4, sticky="ew", pady=(0,2))
+        self.text_redaction_patterns.insert("1.0", "\n".join(state.data.get("redaction_patterns", [])))
 
         excluded_paths_lf = ttk.Labelframe(settings_frame, text="Excluded Specific Files or Folders (Absolute Paths)")
         excluded_paths_lf.grid(row=2, column=0, columnspan=3, sticky="ew", pady=5, padx=5)
@@ -469,9 +3684,77 @@ class ContextBuilderGUI:
         ttk.Button(path_button_frame, text="Exclude File(s)...", command=lambda: self.add_exc(mode="files")).pack(side="left")
         ttk.Button(path_button_frame, text="Exclude Folder...", command=lambda: self.add_exc(mode="folder")).pack(side="left", padx=5)
         ttk.Button(path_button_frame, text="Remove Selected", command=self.remove_exc).pack(side="left", padx=5)
+        self.var_use_ignore_files = tk.BooleanVar(value=state.data.get("use_ignore_files", True))
+        ttk.Checkbutton(excluded_paths_lf, text="Also exclude files matched by .gitignore / .ignore files", variable=self.var_use_ignore_files).grid(row=2, column=0, columnspan=3, sticky="w", padx=5, pady=(0,5))
+
+        build_lf = ttk.Labelframe(settings_frame, text="Build")
+        build_lf.grid(row=3, column=0, columnspan=3, sticky="ew", pady=5, padx=5)
+        ttk.Label(build_lf, text="Parallel file readers:").grid(row=0, column=0, sticky="w", padx=5, pady=5)
+        self.var_read_workers = tk.IntVar(value=state.data.get("read_workers", DEFAULT_READ_WORKERS))
+        ttk.Spinbox(build_lf, from_=1, to=64, width=5, textvariable=self.var_read_workers).grid(row=0, column=1, sticky="w", padx=5, pady=5)
+        self.var_use_content_cache = tk.BooleanVar(value=state.data.get("use_content_cache", True))
+        ttk.Checkbutton(build_lf, text="Cache file contents between builds, up to (MB):", variable=self.var_use_content_cache).grid(row=1, column=0, sticky="w", padx=5, pady=(0,5))
+        self.var_content_cache_max_mb = tk.IntVar(value=state.data.get("content_cache_max_mb", DEFAULT_CONTENT_CACHE_MAX_MB))
+        ttk.Spinbox(build_lf, from_=1, to=100000, width=7, textvariable=self.var_content_cache_max_mb).grid(row=1, column=1, sticky="w", padx=5, pady=(0,5))
+        ttk.Button(build_lf, text="Clear Cache", command=self.clear_content_cache).grid(row=1, column=2, sticky="w", padx=5, pady=(0,5))
+        self.var_watch_mode = tk.BooleanVar(value=state.data.get("watch_mode", False))
+        ttk.Checkbutton(build_lf, text="Watch included folders and keep their contents in memory (faster repeated builds)", variable=self.var_watch_mode).grid(row=2, column=0, columnspan=3, sticky="w", padx=5, pady=(0,5))
+        self.var_use_dir_index = tk.BooleanVar(value=state.data.get("use_dir_index", True))
+        ttk.Checkbutton(build_lf, text="Remember folder listings and skip folders that have not changed", variable=self.var_use_dir_index).grid(row=3, column=0, columnspan=3, sticky="w", padx=5, pady=(0,5))
+        self.var_dedupe = tk.BooleanVar(value=state.data.get("dedupe_identical_files", False))
+        ttk.Checkbutton(build_lf, text="Include identical files only once (later copies point to the first)", variable=self.var_dedupe).grid(row=4, column=0, columnspan=3, sticky="w", padx=5, pady=(0,5))
+        ttk.Label(build_lf, text="Output format:").grid(row=5, column=0, sticky="w", padx=5, pady=(0,5))
+        self.combo_output_format = ttk.Combobox(build_lf, values=list(SERIALIZERS), state="readonly", width=12)
+        self.combo_output_format.set(state.data.get("output_format", "xml"))
+        self.combo_output_format.grid(row=5, column=1, sticky="w", padx=5, pady=(0,5))
+        self.var_collect_stats = tk.BooleanVar(value=state.data.get("collect_build_stats", False))
+        ttk.Checkbutton(build_lf, text="Collect build statistics (stage timings, largest/slowest files, tokens per folder)", variable=self.var_collect_stats).grid(row=6, column=0, columnspan=3, sticky="w", padx=5, pady=(0,5))
+
+        budget_lf = ttk.Labelframe(settings_frame, text="Token Budget")
+        budget_lf.grid(row=4, column=0, columnspan=3, sticky="ew", pady=5, padx=5)
+        budget_lf.columnconfigure(1, weight=1)
+        ttk.Label(budget_lf, text="Target tokens (0 = off):").grid(row=0, column=0, sticky="w", padx=5, pady=5)
+        self.var_token_budget = tk.IntVar(value=state.data.get("token_budget", 0))
+        ttk.Spinbox(budget_lf, from_=0, to=10000000, increment=1000, width=10, textvariable=self.var_token_budget).grid(row=0, column=1, sticky="w", padx=5, pady=5)
+        ttk.Label(budget_lf, text="Tokenizer:").grid(row=0, column=2, sticky="w", padx=5, pady=5)
+        self.combo_tokenizer = ttk.Combobox(budget_lf, values=sorted(TOKEN_COUNTERS), state="readonly", width=12)
+        self.combo_tokenizer.set(state.data.get("tokenizer", "heuristic"))
+        self.combo_tokenizer.grid(row=0, column=3, sticky="w", padx=5, pady=5)
+        ttk.Label(budget_lf, text="Keep first (globs, comma-separated):").grid(row=1, column=0, sticky="w", padx=5, pady=(0,5))
+        self.entry_priority_patterns = ttk.Entry(budget_lf, width=40)
+        self.entry_priority_patterns.grid(row=1, column=1, columnspan=3, sticky="ew", padx=5, pady=(0,5))
+        self.entry_priority_patterns.insert(0, ", ".join(state.data.get("budget_priority_patterns", [])))
+        ttk.Label(budget_lf, text="Skeleton only (globs, comma-separated):").grid(row=2, column=0, sticky="w", padx=5, pady=(0,5))
+        self.entry_skeleton_patterns = ttk.Entry(budget_lf, width=40)
+        self.entry_skeleton_patterns.grid(row=2, column=1, columnspan=3, sticky="ew", padx=5, pady=(0,5))
+        self.entry_skeleton_patterns.insert(0, ", ".join(state.data.get("skeleton_patterns", [])))
+        shard_frame = ttk.Frame(budget_lf)
+        shard_frame.grid(row=3, column=0, columnspan=4, sticky="w", padx=5, pady=(0,5))
+        ttk.Label(shard_frame, text="Split output into shards of at most").pack(side="left")
+        self.var_shard_kb = tk.IntVar(value=state.data.get("shard_max_kb", 0))
+        ttk.Spinbox(shard_frame, from_=0, to=10000000, increment=100, width=8, textvariable=self.var_shard_kb).pack(side="left", padx=5)
+        ttk.Label(shard_frame, text="KB and/or").pack(side="left")
+        self.var_shard_tokens = tk.IntVar(value=state.data.get("shard_max_tokens", 0))
+        ttk.Spinbox(shard_frame, from_=0, to=10000000, increment=1000, width=10, textvariable=self.var_shard_tokens).pack(side="left", padx=5)
+        ttk.Label(shard_frame, text="tokens (0 = no limit)").pack(side="left")
+
+        delta_lf = ttk.Labelframe(settings_frame, text="Changes Only (Delta)")
+        delta_lf.grid(row=5, column=0, columnspan=3, sticky="ew", pady=5, padx=5)
+        ttk.Label(delta_lf, text="Include:").grid(row=0, column=0, sticky="w", padx=5, pady=5)
+        self.combo_delta_mode = ttk.Combobox(delta_lf, values=DELTA_MODES, state="readonly", width=10)
+        self.combo_delta_mode.set(state.data.get("delta_mode", "off"))
+        self.combo_delta_mode.grid(row=0, column=1, sticky="w", padx=5, pady=5)
+        ttk.Label(delta_lf, text="Git revision:").grid(row=0, column=2, sticky="w", padx=5, pady=5)
+        self.entry_delta_revision = ttk.Entry(delta_lf, width=20)
+        self.entry_delta_revision.grid(row=0, column=3, sticky="w", padx=5, pady=5)
+        self.entry_delta_revision.insert(0, state.data.get("delta_git_revision", "HEAD"))
+        self.var_delta_diffs = tk.BooleanVar(value=state.data.get("delta_include_diffs", False))
+        ttk.Checkbutton(delta_lf, text="Send unified diffs for modified files", variable=self.var_delta_diffs).grid(row=1, column=0, columnspan=2, sticky="w", padx=5, pady=(0,5))
+        self.var_record_snapshots = tk.BooleanVar(value=state.data.get("record_snapshots", True))
+        ttk.Checkbutton(delta_lf, text="Record a snapshot on every build", variable=self.var_record_snapshots).grid(row=1, column=2, columnspan=2, sticky="w", padx=5, pady=(0,5))
 
         btn_save_settings = ttk.Button(settings_frame, text="Save & Close Settings", command=self.save_settings, style="Accent.TButton")
-        btn_save_settings.grid(row=3, column=0, columnspan=3, pady=10, padx=5, sticky="e")
+        btn_save_settings.grid(row=6, column=0, columnspan=3, pady=10, padx=5, sticky="e")
         self.settings_win.bind('<Escape>', lambda e: self.settings_win.destroy())
 
     def test_url(self):
@@ -481,11 +3764,21 @@ class ContextBuilderGUI:
         self.settings_win.title("Settings - Testing URL...")
         self.settings_win.update_idletasks()
         try:
+            import requests
             r = requests.get(url, timeout=5); r.raise_for_status()
             messagebox.showinfo("URL Test", "Successfully fetched.", parent=self.settings_win)
         except Exception as e: messagebox.showerror("URL Test", f"Failed: {e}", parent=self.settings_win)
         finally: self.settings_win.title(original_title)
 
+    def clear_content_cache(self):
+        try:
+            cache = state.content_cache
+            if cache is None and (state.config_dir / CACHE_FILE_CONTENT).exists():
+                cache = ContentCache(state.config_dir / CACHE_FILE_CONTENT, 0)
+            if cache is not None: cache.clear()
+            messagebox.showinfo("Content Cache", "Content cache cleared.", parent=self.settings_win)
+        except Exception as e: messagebox.showerror("Content Cache", f"Failed: {e}", parent=self.settings_win)
+
     def add_ext(self):
         ext = simpledialog.askstring("Add Extension", "Extension (e.g., .log):", parent=self.settings_win)
         if ext:
@@ -511,17 +3804,67 @@ class ContextBuilderGUI:
         if sel: self.list_excluded_paths.delete(sel[0])
 
     def save_settings(self):
-        state.data["use__custom_instructions"] = self.var_use_custom.get() # Typo: use_custom_instructions
+        redaction_patterns = [pat.strip() for pat in self.text_redaction_patterns.get("1.0", "end").splitlines() if pat.strip()]
+        for pat in redaction_patterns:
+            try: re.compile(pat)
+            except re.error as e:
+                messagebox.showerror("Settings", f"Invalid secret pattern {pat!r}: {e}", parent=self.settings_win); return
+        state.data["redact_secrets"] = self.var_redact_secrets.get()
+        state.data["redaction_patterns"] = redaction_patterns
+        state.data["use_custom_instructions"] = self.var_use_custom.get()
         state.data["custom_instructions_url"] = self.entry_url.get().strip()
+        try: state.data["custom_instructions_ttl_minutes"] = max(0, int(self.var_custom_ttl.get()))
+        except (tk.TclError, ValueError): pass
         state.data["excluded_types"] = sorted(list(set(self.list_excluded_types.get(0, tk.END))))
         state.data["excluded_paths"] = sorted(list(set(self.list_excluded_paths.get(0, tk.END))))
+        state.data["use_ignore_files"] = self.var_use_ignore_files.get()
+        try: state.data["read_workers"] = max(1, int(self.var_read_workers.get()))
+        except (tk.TclError, ValueError): pass
+        state.data["use_content_cache"] = self.var_use_content_cache.get()
+        state.data["use_dir_index"] = self.var_use_dir_index.get()
+        state.data["dedupe_identical_files"] = self.var_dedupe.get()
+        state.data["output_format"] = self.combo_output_format.get() or "xml"
+        state.data["collect_build_stats"] = self.var_collect_stats.get()
+        state.data["watch_mode"] = self.var_watch_mode.get()
+        set_watch_mode(state.data["watch_mode"])
+        if state.watcher is not None: state.watcher.request_rescan()
+        state.data["detect_binary_files"] = self.var_detect_binary.get()
+        try: state.data["token_budget"] = max(0, int(self.var_token_budget.get()))
+        except (tk.TclError, ValueError): pass
+        state.data["tokenizer"] = self.combo_tokenizer.get() or "heuristic"
+        state.data["budget_priority_patterns"] = [pat.strip() for pat in self.entry_priority_patterns.get().split(",") if pat.strip()]
+        state.data["skeleton_patterns"] = [pat.strip() for pat in self.entry_skeleton_patterns.get().split(",") if pat.strip()]
+        try:
+            state.data["shard_max_kb"] = max(0, int(self.var_shard_kb.get()))
+            state.data["shard_max_tokens"] = max(0, int(self.var_shard_tokens.get()))
+        except (tk.TclError, ValueError): pass
+        state.data["delta_mode"] = self.combo_delta_mode.get() or "off"
+        state.data["delta_git_revision"] = self.entry_delta_revision.get().strip() or "HEAD"
+        state.data["delta_include_diffs"] = self.var_delta_diffs.get()
+        state.data["record_snapshots"] = self.var_record_snapshots.get()
+        try:
+            state.data["large_file_threshold_kb"] = max(0, int(self.var_large_file_kb.get()))
+            state.data["large_file_excerpt_kb"] = max(1, int(self.var_excerpt_kb.get()))
+        except (tk.TclError, ValueError): pass
+        try: state.data["content_cache_max_mb"] = max(1, int(self.var_content_cache_max_mb.get()))
+        except (tk.TclError, ValueError): pass
         state.save_config()
         self.settings_win.destroy(); self.settings_win = None
         messagebox.showinfo("Settings Saved", "Settings saved.", parent=self.master)
 
-def main():
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv:
+        sys.exit(run_cli(argv))
+    run_gui()
+
+def run_gui():
     if getattr(sys, 'frozen', False) and hasattr(sys, '_MEIPASS'):
         os.chdir(Path(sys.executable).parent)
+    load_gui_modules()
+    state.load_config()
+    prefetch_custom_instructions()
+    if state.data.get("watch_mode"): set_watch_mode(True)
     root = tk.Tk()
     try:
         style = ttk.Style(root)
@@ -532,5 +3875,268 @@ def main():
     app = ContextBuilderGUI(root)
     root.mainloop()
 
+def build_cli_parser():
+    import argparse
+    parser = argparse.ArgumentParser(prog="context-builder", description="Build LLM context from files and folders without the GUI. Run without arguments to open the GUI.")
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("paths", nargs="*", help="Files or folders to include (default: included paths from the config/profile)")
+    common.add_argument("--config", metavar="FILE", help="Read settings from this JSON file instead of ~/.context_builder/config.json")
+    common.add_argument("--workspace", metavar="NAME", help="Use the included paths of a named workspace")
+    common.add_argument("--profile", metavar="NAME", help="Apply a named profile from the config's \"profiles\" section")
+    common.add_argument("--exclude", action="append", default=[], metavar="PATH", help="Exclude a file or folder (repeatable)")
+    common.add_argument("--exclude-ext", action="append", default=[], metavar="EXT", help="Exclude a file extension, e.g. .log (repeatable)")
+    common.add_argument("--no-ignore-files", action="store_true", help="Do not honour .gitignore/.ignore files")
+    common.add_argument("--workers", type=int, metavar="N", help="Parallel file readers")
+    common.add_argument("--no-cache", action="store_true", help="Do not use the persistent content cache")
+    common.add_argument("--no-index", action="store_true", help="List every folder instead of reusing the directory index")
+    common.add_argument("-v", "--verbose", action="store_true", help="Print content cache and directory index hits and misses to stderr")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p_build = sub.add_parser("build", parents=[common], help="Write the context document")
+    p_build.add_argument("--stats-json", metavar="FILE", help="Time each stage and write the build statistics report to FILE")
+    p_build.add_argument("-f", "--format", choices=sorted(SERIALIZERS), help="Output format (default: xml or the saved setting)")
+    p_build.add_argument("-o", "--output", metavar="FILE", help="Write to FILE instead of stdout (a folder when sharding)")
+    p_build.add_argument("--copy", action="store_true", help="Copy to the clipboard instead of writing to stdout")
+    p_build.add_argument("-i", "--instructions", default="", metavar="TEXT", help="Task instructions")
+    p_build.add_argument("--instructions-file", metavar="FILE", help="Read task instructions from FILE ('-' for stdin)")
+    p_build.add_argument("--error-output", default="", metavar="TEXT", help="Prior error/output")
+    p_build.add_argument("--error-output-file", metavar="FILE", help="Read prior error/output from FILE ('-' for stdin)")
+    custom = p_build.add_mutually_exclusive_group()
+    custom.add_argument("--custom-instructions", dest="use_custom_instructions", action="store_true", default=None, help="Include custom instructions")
+    custom.add_argument("--no-custom-instructions", dest="use_custom_instructions", action="store_false", help="Leave out custom instructions")
+    p_build.add_argument("--token-budget", type=int, metavar="N", help="Pack files to fit N tokens (0 = off)")
+    p_build.add_argument("--tokenizer", choices=sorted(TOKEN_COUNTERS), help="Token counter used for the budget")
+    dedupe = p_build.add_mutually_exclusive_group()
+    dedupe.add_argument("--dedupe", dest="dedupe_identical_files", action="store_true", default=None, help="Emit identical files once; later copies reference the first")
+    dedupe.add_argument("--no-dedupe", dest="dedupe_identical_files", action="store_false", help="Emit every file in full")
+    p_build.add_argument("--shard-kb", type=int, metavar="N", help="Split the output into shards of at most N KB (0 = off)")
+    p_build.add_argument("--shard-tokens", type=int, metavar="N", help="Split the output into shards of at most N tokens (0 = off)")
+    redact = p_build.add_mutually_exclusive_group()
+    redact.add_argument("--redact", action="append", default=[], metavar="REGEX", help="Also mask text matching REGEX (repeatable)")
+    redact.add_argument("--no-redact", dest="redact_secrets", action="store_false", default=None, help="Do not mask secrets")
+    p_build.add_argument("--skeleton", action="append", default=[], metavar="GLOB",
+                         help="Send only signatures, docstrings and imports for matching files (repeatable)")
+    p_build.add_argument("--delta", choices=DELTA_MODES, help="Only include files changed since the last snapshot or a git revision")
+    p_build.add_argument("--since", metavar="REV", help="Git revision to compare against (implies --delta git)")
+    p_build.add_argument("--diffs", action="store_true", default=None, help="Send unified diffs for modified files in delta mode")
+
+    sub.add_parser("list", parents=[common], help="List the files that would be included")
+    p_stats = sub.add_parser("stats", parents=[common], help="Show file, byte and estimated token counts")
+    p_stats.add_argument("--json", action="store_true", help="Print the stats as JSON")
+    p_stats.add_argument("--formats", action="store_true", help="Also build the context in every output format and report its size")
+    return parser
+
+def apply_cli_options(args):
+    state.load_config(args.config)
+    if args.workspace:
+        state.switch_workspace(args.workspace)
+    if args.profile:
+        state.apply_profile(args.profile)
+    if args.paths:
+        state.data["included_paths"] = [Path(p).resolve().as_posix() for p in args.paths]
+    state.data["excluded_paths"] = list(state.data["excluded_paths"]) + [Path(p).resolve().as_posix() for p in args.exclude]
+    for ext in args.exclude_ext:
+        ext = ext.strip().lower()
+        if not ext.startswith("."): ext = "." + ext
+        if ext not in state.data["excluded_types"]:
+            state.data["excluded_types"] = list(state.data["excluded_types"]) + [ext]
+    if args.no_ignore_files:
+        state.data["use_ignore_files"] = False
+    if args.workers:
+        state.data["read_workers"] = max(1, args.workers)
+    if args.no_cache:
+        state.data["use_content_cache"] = False
+    if args.no_index:
+        state.data["use_dir_index"] = False
+    if getattr(args, "use_custom_instructions", None) is not None:
+        state.data["use_custom_instructions"] = args.use_custom_instructions
+    if getattr(args, "token_budget", None) is not None:
+        state.data["token_budget"] = max(0, args.token_budget)
+    if getattr(args, "tokenizer", None):
+        state.data["tokenizer"] = args.tokenizer
+    if getattr(args, "format", None):
+        state.data["output_format"] = args.format
+    if getattr(args, "stats_json", None):
+        state.data["collect_build_stats"] = True
+    if getattr(args, "dedupe_identical_files", None) is not None:
+        state.data["dedupe_identical_files"] = args.dedupe_identical_files
+    if getattr(args, "shard_kb", None) is not None:
+        state.data["shard_max_kb"] = max(0, args.shard_kb)
+    if getattr(args, "shard_tokens", None) is not None:
+        state.data["shard_max_tokens"] = max(0, args.shard_tokens)
+    if getattr(args, "redact_secrets", None) is not None:
+        state.data["redact_secrets"] = args.redact_secrets
+    if getattr(args, "redact", None):
+        state.data["redaction_patterns"] = list(state.data.get("redaction_patterns", [])) + args.redact
+    if getattr(args, "skeleton", None):
+        state.data["skeleton_patterns"] = list(state.data.get("skeleton_patterns", [])) + args.skeleton
+    if getattr(args, "since", None):
+        state.data["delta_mode"] = "git"
+        state.data["delta_git_revision"] = args.since
+    if getattr(args, "delta", None):
+        state.data["delta_mode"] = args.delta
+    if getattr(args, "diffs", None):
+        state.data["delta_include_diffs"] = True
+
+def read_cli_text(text, file_arg):
+    if not file_arg:
+        return text
+    if file_arg == "-":
+        return sys.stdin.read()
+    return Path(file_arg).read_text(encoding="utf-8", errors="replace")
+
+def run_cli(argv):
+    args = build_cli_parser().parse_args(argv)
+    try:
+        apply_cli_options(args)
+    except KeyError as e:
+        print(f"context-builder: {e.args[0]}", file=sys.stderr)
+        return 2
+    if args.command == "list":
+        status = cli_list()
+    elif args.command == "stats":
+        status = cli_stats(args.json, args.formats)
+    else:
+        status = cli_build(args)
+    if args.verbose:
+        print_cache_stats()
+    return status
+
+def print_cache_stats():
+    if state.content_cache is not None and state.data.get("use_content_cache", True):
+        print(state.content_cache.stats_text(), file=sys.stderr)
+    if state.dir_index is not None and state.data.get("use_dir_index", True):
+        print(state.dir_index.stats_text(), file=sys.stderr)
+
+def cli_build(args):
+    task_instructions = read_cli_text(args.instructions, args.instructions_file).strip()
+    error_output = read_cli_text(args.error_output, args.error_output_file).strip()
+    if sharding_enabled():
+        if not args.copy and not args.output:
+            print("context-builder: sharded output needs -o FOLDER or --copy", file=sys.stderr)
+            return 2
+        try:
+            if args.copy:
+                copy_shards_interactively(task_instructions, error_output)
+            else:
+                paths = write_shards(args.output, task_instructions, error_output)
+                print(f"Wrote {len(paths)} shards to {args.output}", file=sys.stderr)
+        except KeyboardInterrupt:
+            print("\nStopped; later shards were not copied.", file=sys.stderr)
+            return 1
+        except Exception as e:
+            print(f"context-builder: error building context: {e}", file=sys.stderr)
+            return 1
+        print_build_summary(args)
+        return 0
+    try:
+        if args.copy:
+            buf = io.StringIO()
+            write_context(buf, task_instructions, error_output)
+            copy_text_to_clipboard(buf.getvalue())
+        elif args.output:
+            with open(args.output, "w", encoding="utf-8", newline="") as f:
+                write_context(f, task_instructions, error_output)
+        else:
+            if hasattr(sys.stdout, "reconfigure"):
+                sys.stdout.reconfigure(encoding="utf-8", errors="replace")
+            write_context(sys.stdout, task_instructions, error_output)
+            sys.stdout.write("\n")
+            sys.stdout.flush()
+    except BrokenPipeError:
+        # Reader went away (e.g. piped into head); not an error for us
+        sys.stdout = None
+        return 0
+    except Exception as e:
+        print(f"context-builder: error building context: {e}", file=sys.stderr)
+        return 1
+    print_build_summary(args)
+    return 0
+
+def print_build_summary(args):
+    if state.last_budget_plan is not None:
+        print(state.last_budget_plan.report_text(), file=sys.stderr)
+    if state.last_dedup is not None:
+        print(state.last_dedup.stats_text(), file=sys.stderr)
+    if state.last_redactions is not None and state.last_redactions.counts:
+        print(state.last_redactions.stats_text(), file=sys.stderr)
+    if args.stats_json and state.last_build_stats is not None:
+        save_build_stats(state.last_build_stats, args.stats_json)
+
+def copy_shards_interactively(task_instructions, error_output):
+    # Shards are built on demand: the next one is produced only after Enter is pressed
+    for shard in iter_shards(task_instructions, error_output):
+        copy_text_to_clipboard(shard.text)
+        print(f"Shard {shard.index} copied ({len(shard.entries)} files, {len(shard.text.encode('utf-8', errors='surrogatepass')) / 1024:.1f} KB).",
+              file=sys.stderr)
+        if shard.final:
+            print("That was the last shard.", file=sys.stderr)
+            break
+        print("Press Enter to copy the next shard (Ctrl+C to stop)...", file=sys.stderr, end="", flush=True)
+        if not sys.stdin.readline():
+            raise KeyboardInterrupt
+
+def cli_list():
+    base_for_relpath = get_base_for_relpath()
+    try:
+        for fpath_str in collect_included_files():
+            print(relative_display_path(fpath_str, base_for_relpath))
+    except BrokenPipeError:
+        sys.stdout = None
+    return 0
+
+def measure_output_formats(task_instructions="", error_output="", names=None):
+    # Size of the whole document in each output format, streamed so nothing is kept.
+    # Snapshots are not recorded while measuring, so a following delta build is unaffected.
+    saved = {k: state.data.get(k) for k in ("record_snapshots", "delta_mode")}
+    state.data["record_snapshots"] = False
+    if state.data.get("delta_mode") == "snapshot":
+        state.data["delta_mode"] = "off"
+    counter = get_token_counter()
+    sizes = {}
+    try:
+        for name in names or SERIALIZERS:
+            nbytes = tokens = 0
+            for line in iter_context(task_instructions, error_output, serializer=get_serializer(name)):
+                nbytes += len(line.encode("utf-8", errors="surrogatepass")) + 1
+                tokens += counter.count(line)
+            sizes[name] = {"bytes": max(nbytes - 1, 0), "tokens": tokens}
+    finally:
+        state.data.update(saved)
+    return sizes
+
+def cli_stats(as_json, formats=False):
+    files = collect_included_files()
+    total_bytes = 0
+    by_ext = collections.Counter()
+    for fpath_str in files:
+        try:
+            size = os.stat(fpath_str).st_size
+        except OSError:
+            continue
+        total_bytes += size
+        by_ext[os.path.splitext(fpath_str)[1].lower() or "(none)"] += size
+    stats = {"files": len(files), "bytes": total_bytes,
+             "estimated_tokens": (total_bytes + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN,
+             "bytes_by_extension": dict(by_ext.most_common())}
+    if formats:
+        stats["output_formats"] = measure_output_formats()
+    if as_json:
+        print(json.dumps(stats, indent=2))
+    else:
+        print(f"Files: {stats['files']}")
+        print(f"Bytes: {stats['bytes']}")
+        print(f"Estimated tokens: ~{stats['estimated_tokens']}")
+        for ext, size in by_ext.most_common(10):
+            print(f"  {ext}: {size} bytes")
+        if formats:
+            print(f"Output size per format ({get_token_counter().name} tokens):")
+            for name, size in stats["output_formats"].items():
+                print(f"  {name}: {size['bytes']} bytes, ~{size['tokens']} tokens")
+    return 0
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    # Skeleton workers are spawned processes; frozen executables must not rerun the GUI in them
+    import multiprocessing
+    multiprocessing.freeze_support()
+    main()